@@ -1,19 +1,23 @@
 from __future__ import division
 
+import warnings
 import pandas as pd
 import numpy as np
-from scipy import stats
-from scipy.signal import correlate
-import matplotlib.pyplot as plt
 import fileops as fop
+import profiling as prof
+
+# scipy.stats, scipy.fftpack and pyplot are imported where they are used, to keep
+# the import of this module (and of headless workers) light
 
 # better to just apply this function to the columns
 
 
+@prof.profiled
 def fft_df(df):
 
     fs = 41.7
     len_sig = len(df)
+    freq = np.fft.rfftfreq(len_sig, d=1. / fs)
     fft_out = []
     for col in df.columns:
         signal = df[col]
@@ -21,9 +25,6 @@ def fft_df(df):
         fft = abs(np.fft.rfft(signal))
         fft_out.append(fft)
 
-        freq = np.fft.rfftfreq(len_sig,
-                               d=1. / fs)
-
     fft_out = np.array(fft_out).T
 
     # 2 frequencies w/ the greatest power
@@ -36,29 +37,259 @@ def fft_df(df):
     return df_out, freq, f2
 
 
+@prof.profiled
 def meanpeaks_df(df, frac):
+    from scipy import stats
+
     # removing outliers
     df = df[(np.abs(stats.zscore(df)) < 3).all(axis=1)]
     return df[df > frac * df.max()].mean().values
 
 
-def phase_df(df, isplot=False):
-    x1 = df.values
-    x2 = df.values
-    nsamp, ncols = x1.shape
-    end = int(nsamp * 0.95)
-
-    xcorr = correlate(x1, x2)
-    xcorr = xcorr[0:end, 0:ncols]
+@prof.profiled
+def phase_df(df, isplot=False, max_lag=None):
+    '''Lag of the max cross-correlation between channel pairs.
+    Optionally only search lags up to `max_lag` samples.
+    '''
+    xcorr, lags = xcorr_lags(df.values[np.newaxis], max_lag)
+    xcorr = xcorr[0]
 
     if isplot:
+        import matplotlib.pyplot as plt
         fig, ax = plt.subplots()
-        plt.plot(xcorr)
+        plt.plot(lags, xcorr)
+
+    return -lags[xcorr.argmax(axis=0)]
+
+
+@prof.profiled
+def xcorr_lags(arr, max_lag=None):
+    '''Cross-correlate the channel pairs of a (n_files, n_samp, n_chan) array.
+    Column j sums the pairs (m + j - n_chan + 1, m), i.e. the first n_chan columns of the
+    full 2-D correlation. Only the lags 1 - n_samp ... -5% of n_samp are kept, or just
+    those within `max_lag` samples, which also shortens the FFT.
+    Returns the correlation (n_files, n_lags, n_chan) and the lags.
+    '''
+    from scipy.fftpack import next_fast_len
+
+    nsamp = arr.shape[1]
+    lag_min, lag_max = lag_range(nsamp, max_lag)
+
+    # long enough that positive lags don't wrap around onto the ones we keep
+    nfft = next_fast_len(nsamp - lag_min)
+
+    spec = np.fft.rfft(arr, n=nfft, axis=1)
+    return xcorr_spec(spec, nfft, lag_min, lag_max)
+
+
+def lag_range(nsamp, max_lag=None):
+    '''First and last lag searched by the phase features, for windows of nsamp
+    '''
+    end = int(nsamp * 0.95)
+
+    lag_max = end - nsamp
+    lag_min = 1 - nsamp
+    if max_lag is not None:
+        lag_min = max(lag_min, -max_lag)
+    if lag_min > lag_max:
+        raise ValueError('max_lag must be at least %d samples' % -lag_max)
+
+    return lag_min, lag_max
+
+
+def xcorr_spec(spec, nfft, lag_min, lag_max):
+    '''xcorr_lags() from the spectra of the windows, zero-padded to nfft samples
+    '''
+    ncols = spec.shape[2]
+    cross = np.empty(spec.shape, dtype=spec.dtype)
+    for j in range(ncols):
+        cross[:, :, j] = (spec[:, :, :j + 1] *
+                          np.conj(spec[:, :, ncols - 1 - j:])).sum(axis=2)
+
+    # negative lags are at the end of the circular correlation
+    xcorr = np.fft.irfft(cross, n=nfft, axis=1)
+    xcorr = xcorr[:, nfft + lag_min:nfft + lag_max + 1, :]
 
-    dt = np.arange(1 - nsamp, nsamp)
-    return -dt[xcorr.argmax(axis=0)]
+    return xcorr, np.arange(lag_min, lag_max + 1)
+
+
+# batched versions of the above, for a (n_files, n_samp, n_chan) array of windows
+
+
+@prof.profiled
+def fft_batch(arr, fs=41.7):
+    '''Spectra for all windows at once. Same as fft_df() applied to each window.
+    Returns the spectra, the frequencies and the 2 strongest frequencies per window
+    '''
+    spec = np.abs(np.fft.rfft(arr, axis=1))
+    freq = np.fft.rfftfreq(arr.shape[1], d=1. / fs)
+
+    return spec, freq, top_freqs(spec, freq)
+
+
+def top_freqs(spec, freq):
+    '''The 2 frequencies w/ the greatest power (summed over channels) of each spectrum
+    in the (n_files, n_freq, n_chan) array spec, as picked by fft_df()
+    '''
+    ix = np.argsort(spec.sum(axis=2), axis=1)
+    return freq[ix[:, -3:-1]]
+
+
+# Hann window, frequencies and psd scale per (segment length, fs), see welch_plan()
+_welch_plans = {}
+
+
+def welch_plan(nperseg, fs=41.7):
+    '''Window, frequency grid and psd scale of welch_batch() for segments of nperseg.
+    Made once per (nperseg, fs) and reused.
+    '''
+    key = (nperseg, fs)
+    if key not in _welch_plans:
+        win = np.hanning(nperseg + 1)[:-1]   # periodic, as scipy.signal.welch
+        freq = np.fft.rfftfreq(nperseg, d=1. / fs)
+        scale = np.full(len(freq), 2. / (fs * (win ** 2).sum()))
+        scale[0] /= 2   # DC and Nyquist are not doubled in the one-sided psd
+        if nperseg % 2 == 0:
+            scale[-1] /= 2
+        _welch_plans[key] = win, freq, scale
+    return _welch_plans[key]
+
+
+@prof.profiled
+def welch_batch(arr, nperseg=128, fs=41.7):
+    '''Welch power spectra for all windows and channels at once: the mean of the
+    spectra of half-overlapping, Hann-windowed segments of nperseg samples, each with
+    its mean removed. Segments are capped at the window length.
+    Returns the spectra (n_files, n_freq, n_chan), the frequencies and the 2 strongest
+    frequencies per window, strongest first.
+    '''
+    n_files, n_samp, n_chan = arr.shape
+    nperseg = min(nperseg, n_samp)
+    step = nperseg - nperseg // 2   # scipy's noverlap is nperseg // 2
+    n_seg = (n_samp - nperseg) // step + 1
+    win, freq, scale = welch_plan(nperseg, fs)
+
+    # (n_files, n_seg, nperseg, n_chan) view of the segments
+    arr = np.ascontiguousarray(arr, dtype=np.float64)
+    s_file, s_samp, s_chan = arr.strides
+    segs = np.lib.stride_tricks.as_strided(
+        arr, (n_files, n_seg, nperseg, n_chan), (s_file, step * s_samp, s_samp, s_chan),
+        writeable=False)
+
+    segs = (segs - segs.mean(axis=2, keepdims=True)) * win[:, np.newaxis]
+    spec = np.fft.rfft(segs, axis=2)
+    psd = (spec.real ** 2 + spec.imag ** 2).mean(axis=1) * scale[:, np.newaxis]
+
+    ix = np.argsort(psd.sum(axis=2), axis=1)
+    return psd, freq, freq[ix[:, :-3:-1]]
+
+
+@prof.profiled
+def meanpeaks_batch(arr, frac, robust=False, chunksize=64):
+    '''Mean of the peaks in each channel of each window. Same as meanpeaks_df().
+    Windows are done chunksize at a time, in one scratch array reused throughout, so
+    the temporaries stay at the size of a chunk however many windows there are.
+    With `robust`, outliers are samples more than 3 scaled MADs from the median of a
+    channel, instead of 3 standard deviations from its mean.
+    '''
+    n_files, n_samp, n_chan = arr.shape
+    peaks = np.empty((n_files, n_chan))
+    buf = np.empty((min(chunksize, n_files), n_samp, n_chan))
 
+    for start in range(0, n_files, chunksize):
+        x = np.asarray(arr[start:start + chunksize], dtype=np.float64)
+        chunk_buf = buf[:len(x)]
+        keep = _outlier_mask(x, chunk_buf, robust)
+        _, peaks[start:start + len(x)] = _masked_peaks(x, chunk_buf, keep, frac)
 
+    return peaks
+
+
+@prof.profiled
+def phase_batch(arr, max_lag=None):
+    '''Lag of the max cross-correlation for all windows. Same as phase_df().
+    '''
+    xcorr, lags = xcorr_lags(arr, max_lag)
+    return -lags[xcorr.argmax(axis=1)]
+
+
+# bump when a feature calculation changes, so cached features are not reused
+FEATURE_VERSION = 4
+
+
+@prof.profiled
+def features_batch(arr, max_lag=None, nperseg=None, robust=False, chunksize=64):
+    '''Peak, frequency and phase features for all windows, as one row per window.
+    With nperseg, f1 and f2 are the 2 strongest frequencies of the Welch spectrum
+    with segments of nperseg samples, instead of those picked from the raw spectrum.
+    With `robust`, peaks leave out outliers by median and MAD (see meanpeaks_batch()).
+    Windows are done chunksize at a time, so the float and complex temporaries stay
+    at the size of a chunk however many windows there are (e.g. a strided view of
+    every window of a long recording).
+    '''
+    n_files, n_samp, n_chan = arr.shape
+    feat = np.empty((n_files, 2 * n_chan + 2))
+    buf = np.empty((min(chunksize, n_files), n_samp, n_chan))
+
+    for start in range(0, n_files, chunksize):
+        chunk = arr[start:start + chunksize]
+        stats = fused_stats(chunk, 0.5, qc=False, robust=robust, buf=buf)
+        phase = phase_batch(chunk, max_lag)
+
+        if nperseg is None:
+            fc = stats['f2'][:, ::-1]
+        else:
+            _, _, fc = welch_batch(chunk, nperseg)
+
+        feat[start:start + len(chunk)] = np.concatenate((stats['peaks'], fc, phase), axis=1)
+
+    return feat
+
+
+@prof.profiled
+def fused_stats(arr, frac=0.5, fs=41.7, qc=True, robust=False, chunksize=64, buf=None):
+    '''Per-window statistics of a (n_files, n_samp, n_chan) array, computed together:
+    * qc - the metrics of quality_arr() for each window (a list of dicts)
+    * keep - (n_files, n_samp) mask of samples without a channel at |zscore| >= 3
+      (or more than 3 scaled MADs from the median, with `robust`)
+    * peak, peaks - the max and the mean of the peaks above frac * max of each channel,
+      over the kept samples (peaks is meanpeaks_batch())
+    * spec, freq, f2 - the spectra, frequencies and top 2 frequencies of fft_batch()
+    Windows are converted to float chunksize at a time, and the z-scores, masked maxima
+    and peak sums reuse one scratch array of a chunk (buf, if given), so there are no
+    intermediate tables or copies of the whole array.
+    '''
+    out = {}
+    if qc:
+        out['qc'] = [quality_arr(x) for x in arr]
+
+    n_files, n_samp, n_chan = arr.shape
+    if buf is None:
+        buf = np.empty((min(chunksize, n_files), n_samp, n_chan))
+    chunksize = max(len(buf), 1)
+
+    freq = np.fft.rfftfreq(n_samp, d=1. / fs)
+    keep = np.empty((n_files, n_samp), dtype=bool)
+    peak = np.empty((n_files, n_chan))
+    peaks = np.empty((n_files, n_chan))
+    spec = np.empty((n_files, len(freq), n_chan))
+
+    for start in range(0, n_files, chunksize):
+        x = np.asarray(arr[start:start + chunksize], dtype=np.float64)
+        stop = start + len(x)
+        chunk_buf = buf[:len(x)]
+
+        keep[start:stop] = _outlier_mask(x, chunk_buf, robust)
+        peak[start:stop], peaks[start:stop] = _masked_peaks(x, chunk_buf, keep[start:stop],
+                                                            frac)
+        spec[start:stop] = np.abs(np.fft.rfft(x, axis=1))
+
+    out.update(keep=keep, peak=peak, peaks=peaks, spec=spec, freq=freq,
+               f2=top_freqs(spec, freq))
+    return out
+
+
+@prof.profiled
 def calc_features(data_dict, keys, standardize=False):
     print 'Deprecated. Use top_fcns.get_features()'
     freq = []
@@ -87,6 +318,7 @@ def calc_features(data_dict, keys, standardize=False):
     return feat
 
 
+@prof.profiled
 def quality(csv_path):
     '''Calculate basic quality metrics for csv file.
     * number of rows - to find files that are too short or long enough to sample multiple times
@@ -96,16 +328,116 @@ def quality(csv_path):
     * max fraction of zero values across channels - possibly dead sensors?
     * max fraction of consecutive non-zero values - files with temporal binning issues
     '''
-    df = fop.load_emg(csv_path)
-    len_df = len(df)
+    return quality_arr(fop.load_emg(csv_path).values)
+
+
+@prof.profiled
+def quality_arr(x):
+    '''Quality metrics of quality() for a (n_samp, n_chan) array.
+    All six are reduced straight from the array, without intermediate data frames.
+    Missing (NaN) samples are skipped, as the pandas reductions of quality() did.
+    '''
+    len_df = len(x)
+    if len_df == 0:
+        return {"Length": 0, "Max": np.nan, "Median": np.nan, "N_spikes": 0,
+                "MaxFrac_zero": np.nan, "MaxFrac_repeat": np.nan}
+
+    with np.errstate(invalid='ignore'):
+        # comparisons with NaN are False, so NaN is never below, a spike, zero or repeat
+        below = x[x < 15000]
+        # a repeat is a value > 100 whose diff to the previous sample is 0 (first row
+        # has no diff)
+        repeats = ((x[1:] > 100) & (np.diff(x, axis=0) == 0)).sum(axis=0)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)   # all-NaN gives NaN
+            median = np.nanmedian(x)
+        n_spikes = (x > 65000).sum()
+        n_zeros = (x == 0).sum(axis=0)
 
     quality = {
         "Length": len_df,
-        "Max": df[df < 15000].unstack().max(),
-        "Median": df.unstack().median(),
-        "N_spikes": (df > 65000).sum().sum(),
-        "MaxFrac_zero": max((df == 0).sum().divide(len_df) * 100),
-        # "MaxFrac_repeat": max(((df != 0) & (df.diff() == 0)).sum().divide(len_df) * 100)
-        "MaxFrac_repeat": max(((df > 100) & (df.diff() == 0)).sum().divide(len_df) * 100)
+        "Max": below.max() if below.size else np.nan,
+        "Median": median,
+        "N_spikes": n_spikes,
+        "MaxFrac_zero": n_zeros.max() / len_df * 100,
+        "MaxFrac_repeat": repeats.max() / len_df * 100
     }
     return quality
+
+
+@prof.profiled
+def recording_stats(csv_path, frac=0.5):
+    '''quality() of csv_path, together with the mean peaks (Peak_<col>) and the top 2
+    frequencies (f1, f2) of the whole recording, from one load and one fused_stats()
+    '''
+    return recording_stats_arr(fop.load_emg(csv_path).values, frac)
+
+
+@prof.profiled
+def recording_stats_arr(x, frac=0.5):
+    '''recording_stats() for a (n_samp, n_chan) array
+    '''
+    if len(x) == 0:
+        return quality_arr(x)
+
+    stats = fused_stats(x[np.newaxis], frac)
+    summ = stats['qc'][0]
+    for col, peak in zip(fop.EMG_COLS, stats['peaks'][0]):
+        summ['Peak_' + col] = peak
+    summ['f1'], summ['f2'] = stats['f2'][0, ::-1]
+    return summ
+
+
+# Helper functions
+###################################################
+
+
+def _outlier_mask(x, buf, robust=False):
+    '''(n_files, n_samp) mask of the samples of x where no channel is an outlier.
+    buf is scratch space of the shape of x.
+    '''
+    n_samp = x.shape[1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if robust:
+            median = np.median(x, axis=1, keepdims=True)
+            np.subtract(x, median, out=buf)
+            np.abs(buf, out=buf)
+            # 1.4826 MAD estimates the std of normally distributed data. Where over half
+            # a channel is one value (e.g. a dropout) the MAD is 0, and the mean absolute
+            # deviation (times 1.2533 for the same estimate) is used instead. A constant
+            # channel has no outliers.
+            scale = 1.4826 * np.median(buf, axis=1, keepdims=True)
+            is_zero = scale == 0
+            if is_zero.any():
+                mean_ad = 1.2533 * buf.mean(axis=1, keepdims=True)
+                scale[is_zero] = mean_ad[is_zero]
+                scale[scale == 0] = np.inf
+            np.divide(buf, scale, out=buf)
+        else:
+            # mean and std as np.mean and np.std compute them, so the mask is the same
+            mean = x.sum(axis=1, keepdims=True) / n_samp
+            np.subtract(x, mean, out=buf)
+            np.multiply(buf, buf, out=buf)
+            std = np.sqrt(buf.sum(axis=1, keepdims=True) / n_samp)
+
+            np.subtract(x, mean, out=buf)
+            np.divide(buf, std, out=buf)
+            np.abs(buf, out=buf)
+
+        return (buf < 3).all(axis=2)
+
+
+def _masked_peaks(x, buf, keep, frac):
+    '''Max of each channel over the kept samples, and the mean of the kept samples
+    above frac * max, reduced in buf instead of masked copies of x
+    '''
+    keep = keep[:, :, np.newaxis]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        buf.fill(-np.inf)
+        np.copyto(buf, x, where=keep)
+        peak = buf.max(axis=1)
+
+        is_peak = keep & (x > frac * peak[:, np.newaxis, :])
+        buf.fill(0)
+        np.copyto(buf, x, where=is_peak)
+        return peak, buf.sum(axis=1) / is_peak.sum(axis=1)
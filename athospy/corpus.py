@@ -0,0 +1,129 @@
+'''Persistent index of the data tree, so rescans only look at what changed.
+'''
+import os
+import time
+import json
+import hashlib
+import sqlite3
+
+
+class CorpusIndex(object):
+    '''Directory listings and parsed file-name labels, kept in an SQLite database.
+    A directory is only listed again when its mtime changes, i.e. when entries were
+    added, removed or renamed in it. Otherwise a rescan costs one stat per directory.
+    Labels are parsed once per file and dropped when the file is deleted.
+    '''
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS dirs ('
+                              'path TEXT PRIMARY KEY, mtime REAL, entries TEXT)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS labels ('
+                              'path TEXT, parser TEXT, dir TEXT, mtime REAL, size INTEGER, '
+                              'labels TEXT, PRIMARY KEY (path, parser))')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS labels_dir ON labels (dir, parser)')
+
+    def close(self):
+        self.conn.close()
+
+    def listdir(self, path):
+        '''Return (name, is_dir, is_link) for the entries of path, in os.listdir order.
+        '''
+        mtime = os.stat(path).st_mtime
+        row = self.conn.execute('SELECT mtime, entries FROM dirs WHERE path = ?',
+                                (path,)).fetchone()
+        if row and row[0] == mtime:
+            return [tuple(e) for e in json.loads(row[1])]
+
+        entries = []
+        for name in os.listdir(path):
+            subpath = os.path.join(path, name)
+            entries.append((name, os.path.isdir(subpath), os.path.islink(subpath)))
+
+        if time.time() - mtime < 2:
+            # could still change within the mtime resolution: list again next time
+            mtime = None
+
+        old_entries = [tuple(e) for e in json.loads(row[1])] if row else []
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)',
+                              (path, mtime, json.dumps(entries)))
+            self._drop_deleted(path, old_entries, entries)
+
+        return entries
+
+    def walk(self, top):
+        '''Same as os.walk(top), from the stored listings of unchanged directories.
+        dirnames can be pruned in place, as with os.walk.
+        '''
+        try:
+            entries = self.listdir(top)
+        except OSError:
+            return
+
+        dirnames = [name for name, is_dir, _ in entries if is_dir]
+        fnames = [name for name, is_dir, _ in entries if not is_dir]
+        yield top, dirnames, fnames
+
+        links = set(name for name, _, is_link in entries if is_link)
+        for name in dirnames:
+            if name not in links:
+                for x in self.walk(os.path.join(top, name)):
+                    yield x
+
+    def parse_names(self, dirpath, names, parse_fcn):
+        '''Return parse_fcn(name) for each entry name in dirpath.
+        Results are stored per file and per version of parse_fcn's code and patterns.
+        '''
+        parser = _code_key(parse_fcn)
+        rows = self.conn.execute('SELECT path, labels FROM labels WHERE dir = ? AND parser = ?',
+                                 (dirpath, parser))
+        known = dict((path, json.loads(labels)) for path, labels in rows)
+
+        parsed, new_rows = [], []
+        for name in names:
+            path = os.path.join(dirpath, name)
+            if path in known:
+                labels, label_names = known[path]
+            else:
+                labels, label_names = parse_fcn(name)
+                st = os.stat(path)
+                new_rows.append((path, parser, dirpath, st.st_mtime, st.st_size,
+                                 json.dumps([labels, label_names])))
+            parsed.append((labels, label_names))
+
+        if new_rows:
+            with self.conn:
+                self.conn.executemany('INSERT OR REPLACE INTO labels VALUES (?, ?, ?, ?, ?, ?)',
+                                      new_rows)
+        return parsed
+
+    def _drop_deleted(self, path, old_entries, entries):
+        '''Remove records of entries of path that are gone, including whole sub-trees
+        '''
+        names = set(e[0] for e in entries)
+        for name, is_dir, _ in old_entries:
+            if name in names:
+                continue
+            subpath = os.path.join(path, name)
+            self.conn.execute('DELETE FROM labels WHERE path = ?', (subpath,))
+            if is_dir:
+                prefix = os.path.join(subpath, '')
+                for table, col in [('dirs', 'path'), ('labels', 'dir')]:
+                    self.conn.execute('DELETE FROM %s WHERE %s = ? OR substr(%s, 1, ?) = ?'
+                                      % (table, col, col),
+                                      (subpath, len(prefix), prefix))
+
+
+def _code_key(fcn):
+    '''Name and hash of the code of fcn, and of the regex patterns it parses with (its
+    `patterns` attribute, if any), so stored results are redone when either is edited.
+    Decorated functions are hashed by the code they wrap.
+    '''
+    code = getattr(fcn, '__wrapped__', fcn).__code__
+    patterns = [getattr(p, 'pattern', p) for p in getattr(fcn, 'patterns', [])]
+    digest = hashlib.sha1(code.co_code + repr(code.co_consts).encode('utf-8') +
+                          repr(patterns).encode('utf-8')).hexdigest()
+    return '%s-%s' % (fcn.__name__, digest[:8])
@@ -0,0 +1,99 @@
+'''On-disk cache of feature rows, for re-running get_features() on the same files.
+'''
+from __future__ import division
+
+import os
+import json
+import hashlib
+import numpy as np
+
+# athospy packages
+import calcs as clc
+import fileops as fop
+
+
+class FeatureCache(object):
+    '''Feature rows per file, keyed on the file's content hash, the feature parameters
+    (n_sec, max_lag, ...) and calcs.FEATURE_VERSION. Pass it to get_features(cache=...).
+    The least recently used entries are removed once the cache is over max_bytes.
+    hits, misses and evictions count what happened since it was created.
+    '''
+
+    def __init__(self, cache_dir, max_bytes=500 * 2 ** 20):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            if not os.path.isdir(cache_dir):
+                raise
+        self.n_bytes = sum(os.path.getsize(path) for path in self._entries())
+
+    def key(self, csv_path, params):
+        '''Cache key of the features of csv_path calculated with params (a dict)
+        '''
+        spec = json.dumps([fop.content_hash(csv_path), sorted(params.items()),
+                           clc.FEATURE_VERSION])
+        return hashlib.sha1(spec.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        '''Return (rows, window starts) stored under key, or None
+        '''
+        path = self._path(key)
+        try:
+            with np.load(path) as entry:
+                rows, starts = entry['rows'], entry['starts']
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            return None
+
+        os.utime(path, None)   # mark as recently used
+        self.hits += 1
+        return rows, starts
+
+    def put(self, key, rows, starts):
+        '''Store the feature rows of one file, and the start of each row's window
+        '''
+        path = self._path(key)
+        if os.path.exists(path):
+            self.n_bytes -= os.path.getsize(path)
+        fop.atomic_write(path, lambda f: np.savez(f, rows=rows, starts=starts))
+        self.n_bytes += os.path.getsize(path)
+
+        if self.n_bytes > self.max_bytes:
+            self._evict()
+
+    def stats(self):
+        n_lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'hit_rate': self.hits / n_lookups if n_lookups else np.nan,
+                'n_bytes': self.n_bytes}
+
+    def clear(self):
+        for path in self._entries():
+            os.remove(path)
+        self.n_bytes = 0
+
+    def _evict(self):
+        '''Remove the least recently used entries until the cache is at 90% of max_bytes
+        '''
+        by_age = sorted((os.path.getmtime(path), path) for path in self._entries())
+        for _, path in by_age:
+            if self.n_bytes <= 0.9 * self.max_bytes:
+                break
+            self.n_bytes -= os.path.getsize(path)
+            os.remove(path)
+            self.evictions += 1
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.npz')
+
+    def _entries(self):
+        for root, _, fnames in os.walk(self.cache_dir):
+            for fn in fnames:
+                if fn.endswith('.npz'):
+                    yield os.path.join(root, fn)
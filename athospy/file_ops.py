@@ -7,17 +7,23 @@ import fnmatch          #
 
 # DEPRECATED. Use fileops
 
-EXER_LIST = 'config/exercise-list_short.txt'
-PERS_LIST = 'config/person-list'
+CONFIG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+EXER_LIST = os.path.join(CONFIG_DIR, 'config/exercise-list_short.txt')
+PERS_LIST = os.path.join(CONFIG_DIR, 'config/person-list')
 
 # exer_map = _load_json(EXER_LIST)
 # pers_map = _load_json(PERS_LIST)
 
-f = open(EXER_LIST)
-exercise_set = set()
-for line in f:
-    exercise_set.add( line.rstrip() )
-f.close()
+_exercise_set = None
+
+
+def load_exercise_set():
+    '''Set of known exercises, read from EXER_LIST on first use'''
+    global _exercise_set
+    if _exercise_set is None:
+        with open(EXER_LIST) as f:
+            _exercise_set = set(line.rstrip() for line in f)
+    return _exercise_set
 
 
 # helper functions
@@ -85,7 +91,7 @@ def label_csvs_in_dir(data_dir):
         for fname in fnmatch.filter(fnames, '*.csv'):
             labels = parse_csv_name(fnames)
             if labels:
-                e = get_best_match(exer, exercise_set, cutoff)
+                e = get_best_match(exer, load_exercise_set(), cutoff)
                 if e:
                     personExerDict[p][e].append(csvPath)
                     count += 1
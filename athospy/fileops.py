@@ -1,66 +1,624 @@
 import re
 import os
+import io
+import itertools
+import json
+import hashlib
+import shutil
+import tempfile
+import numpy as np
 import pandas as pd
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from numpy.lib.stride_tricks import as_strided
 
+# athospy packages
+import profiling as prof
+
+try:
+    import fcntl   # for reflinks, unix only
+except ImportError:
+    fcntl = None
+
+# reorder columns for left/right: glut, ham, lat/med: quad
+EMG_COLS = ['LGM', 'LBF', 'LVL', 'LVM', 'RGM', 'RBF', 'RVL', 'RVM']
+
+# binary cache of the EMG channels. Off unless set, see set_cache_dir()
+CACHE_DIR = os.environ.get('ATHOSPY_CACHE', '')
+CACHE_VERIFY = False
+
+# threads reading files ahead of the pipeline, and how many files. See set_prefetch()
+PREFETCH_THREADS = 0
+PREFETCH_DEPTH = 0
+
+# row counts and hashes of csv files, see count_rows() and content_hash()
+_row_index = {}
+_hash_index = {}
+# a line of only whitespace, which pd.read_csv skips, and a line starting with one
+_BLANK_LINE = re.compile(br'^[^\S\n]*\n', re.MULTILINE)
+_SPACE_LINE = re.compile(br'\n\s')
+
+# linux ioctl to clone a file (copy-on-write), see place_file()
+_FICLONE = 0x40049409
+
+
+@prof.profiled
 def load_emg(csv_path):
     '''Load EMG data from the specified CSV file as a pandas data frame
+    Goes through the binary cache, if one is set.
     '''
-    _, ext = os.path.splitext(csv_path)
-    assert ext == '.csv', 'extension must be .csv, not "%s"' % ext
-    
-    df = pd.read_csv(csv_path, header=0)
-    df = df.loc[:,['LGM', 'LBF', 'LVL', 'LVM', 'RGM', 'RBF', 'RVL', 'RVM']]
-    # reorder columns for left/right: glut, ham, lat/med: quad
+    _check_ext(csv_path)
+    if CACHE_DIR:
+        arr = _load_cached(csv_path)
+        # csv columns are parsed as int64 or float64
+        dtype = np.int64 if arr.dtype.kind in 'iu' else np.float64
+        return pd.DataFrame(arr.astype(dtype), columns=EMG_COLS)
 
-    return df
+    return _read_csv_emg(csv_path)
+
+
+@prof.profiled
+def load_emg_array(csv_path, mmap_mode='r'):
+    '''Load EMG data as a (n_samp, 8) array with columns in the order of EMG_COLS.
+    With the cache set, this is a memory map of the compact cached copy.
+    '''
+    _check_ext(csv_path)
+    if CACHE_DIR:
+        return _load_cached(csv_path, mmap_mode)
+
+    return _read_csv_emg(csv_path).values
+
+
+def set_cache_dir(cache_dir, verify=False):
+    '''Cache EMG data under cache_dir, so each csv file is only parsed once.
+    Entries are refreshed when a file's mtime or size changes. With `verify`, the content
+    hash is checked on every load too. An empty cache_dir turns the cache off.
+    '''
+    global CACHE_DIR, CACHE_VERIFY
+    CACHE_DIR = cache_dir
+    CACHE_VERIFY = verify
+
+
+def set_prefetch(n_threads, max_in_flight=None):
+    '''Read files ahead in n_threads threads, where the pipeline loads them one after
+    the other (sample_data, sample_windows, segment_data, check_quality, load_and_plot),
+    so waiting on slow storage overlaps with parsing and calculations. At most
+    max_in_flight files (default 2 * n_threads) are read ahead. 0 threads turns it off.
+    '''
+    global PREFETCH_THREADS, PREFETCH_DEPTH
+    PREFETCH_THREADS = n_threads
+    PREFETCH_DEPTH = max_in_flight or 2 * n_threads
+
+
+def prefetched(func, items):
+    '''Yield func(item) for each item, in order.
+    With prefetching on (see set_prefetch), the calls run ahead in reader threads.
+    '''
+    if not PREFETCH_THREADS:
+        for item in items:
+            yield func(item)
+        return
+
+    pool = ThreadPool(PREFETCH_THREADS)
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(pool.apply_async(func, (item,)))
+            if len(pending) >= PREFETCH_DEPTH:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        # also stops the reads ahead if the consumer quits early
+        pool.terminate()
+        pool.join()
+
+
+def iter_emg(paths):
+    '''Yield the EMG data of each path as a (n_samp, 8) array with the values (and
+    dtypes) of load_emg(), in order, read ahead as set by set_prefetch()
+    '''
+    return prefetched(_load_emg_values, paths)
+
+
+@prof.profiled
+def cache_entry(csv_path):
+    '''Return the cache record of csv_path, converting the file if it is new or changed.
+    Converted data are stored by content hash, so copies of a recording share one entry.
+    '''
+    st = os.stat(csv_path)
+    index_path = os.path.join(CACHE_DIR, 'index',
+                              _hash_str(os.path.abspath(csv_path)) + '.json')
+    try:
+        with open(index_path) as f:
+            entry = json.load(f)
+    except (IOError, ValueError):
+        entry = {}
+
+    is_same = (entry.get('mtime') == st.st_mtime and entry.get('size') == st.st_size and
+               os.path.exists(_blob_path(entry['sha1'])))
+    if is_same and not CACHE_VERIFY:
+        return entry
+
+    sha1 = file_hash(csv_path)
+    if is_same and entry['sha1'] == sha1:
+        return entry
+
+    blob_path = _blob_path(sha1)
+    if not os.path.exists(blob_path):
+        x = _read_csv_emg(csv_path).values
+        atomic_write(blob_path, lambda f: np.save(f, x.astype(_compact_dtype(x))))
+        n_rows = len(x)
+    else:
+        n_rows = len(np.load(blob_path, mmap_mode='r'))
+
+    entry = {'path': csv_path, 'mtime': st.st_mtime, 'size': st.st_size,
+             'sha1': sha1, 'rows': n_rows}
+    atomic_write(index_path, lambda f: json.dump(entry, f))
+    return entry
+
+
+# file-name patterns. A csv name is tried with the second pattern if the first fails
+FOLDER_LABELS = ['First_Last', 'Trial', 'Fitness', 'Push']
+FOLDER_PATTERNS = [re.compile(r"^([a-zA-Z]*_(?:[a-zA-Z]*_)?[a-zA-Z]*)[_ ]Calib.*[_ ]Trial(\d*)[_ ]Fitness(\d*)[_ ]Push(\d*)$")]
+
+CSV_LABELS = ['LastFirst', 'Exercise', 'Legside', 'Resistance', 'Sufffix']
+CSV_PATTERNS = [
+    # try requiring the tag for leg-side
+    re.compile(r"^([a-zA-Z ]+)(?:_| _)([A-Za-z]+)_?([LR])(\d*)(.{0,4})\.csv$"),
+    # try with optional tag for leg-side and permit a longer allowed suffix
+    re.compile(r"^([a-zA-Z ]+)(?:_| _)([A-Za-z]+)_?([LR])?(\d*)(.{0,8})\.csv$")]
+_combined_patterns = {}
 
 
+@prof.profiled
 def parse_folder_name(folder_name):
     '''extract name of person and trial/fitness/push numbers from folder name'''
     # names = ['First', 'Last', 'Trial', 'Fitness', 'Push']
     # labels = re.findall(r"^([a-zA-Z]*)_(?:[a-zA-Z]*_)?([a-zA-Z]*)[_ ]Calib.*[_ ]Trial(\d*)[_ ]Fitness(\d*)[_ ]Push(\d*)$",
     #                     folder_name)
-    names = ['First_Last', 'Trial', 'Fitness', 'Push']
-    labels = re.findall(r"^([a-zA-Z]*_(?:[a-zA-Z]*_)?[a-zA-Z]*)[_ ]Calib.*[_ ]Trial(\d*)[_ ]Fitness(\d*)[_ ]Push(\d*)$",
-                        folder_name)
-    if labels:
-        return list(labels[0]), names
-    return [None] * len(names), names
+    return _parse_name(folder_name, FOLDER_PATTERNS, FOLDER_LABELS)
 
 
+@prof.profiled
 def parse_csv_name(csv_name):
     '''extract person name, excercise name, leg side, number, and suffix labels'''
-    names = ['LastFirst', 'Exercise', 'Legside', 'Resistance', 'Sufffix']
+    return _parse_name(csv_name, CSV_PATTERNS, CSV_LABELS)
 
-    # try requiring the tag for leg-side
-    labels = re.findall(r"^([a-zA-Z ]+)(?:_| _)([A-Za-z]+)_?([LR])(\d*)(.{0,4})\.csv$",
-                        csv_name)
-    if labels:
-        return list(labels[0]), names
 
-    # try with optional tag for leg-side and permit a longer allowed suffix
-    labels = re.findall(r"^([a-zA-Z ]+)(?:_| _)([A-Za-z]+)_?([LR])?(\d*)(.{0,8})\.csv$",
-                        csv_name)
-    if labels:
-        return list(labels[0]), names
-    return [None] * len(names), names
+# what the parsers match with, so stored labels are redone when a pattern is edited
+# (see corpus.CorpusIndex.parse_names)
+parse_folder_name.patterns = FOLDER_PATTERNS
+parse_csv_name.patterns = CSV_PATTERNS
+
+
+@prof.profiled
+def parse_folder_names(names):
+    '''parse_folder_name() of a whole list of names at once, as a data frame
+    '''
+    return _extract_labels(names, FOLDER_PATTERNS, FOLDER_LABELS)
+
+
+@prof.profiled
+def parse_csv_names(names):
+    '''parse_csv_name() of a whole list of names at once, as a data frame
+    '''
+    return _extract_labels(names, CSV_PATTERNS, CSV_LABELS)
 
 
+def compact_labels(df, max_frac=0.5):
+    '''Store text columns with few distinct values (at most max_frac of the rows) as
+    categoricals, and *_id columns in the smallest integer type. Path stays text.
+    '''
+    df = df.copy()
+    for col in df.columns:
+        S = df[col]
+        if col == 'Path':
+            continue
+        if col.endswith('_id') and S.dtype.kind in 'iu':
+            df[col] = pd.to_numeric(S, downcast='integer')
+        elif S.dtype == object and S.nunique(dropna=False) <= max_frac * len(S):
+            df[col] = S.astype('category')
+    return df
+
+
+@prof.profiled
 def sample_data(files, n_sec):
     '''Create dictionary of sampled data, with file ids as keys.
+    Only the sampled window of each file is read, see load_emg_window()
     '''
     # TODO: allow input of single series instead of dataframe?
     n_samp = int(41.7 * n_sec)
 
-    data_dict = {}
-    ix__path = zip(files.index, files.Path)
-    for ix, csv_path in ix__path:
-        df = load_emg(csv_path)
+    def load(csv_path):
+        i_start, i_end = _centre_window(count_rows(csv_path), n_samp)
 
-        i_mid = len(df) // 2
-        i_start = i_mid - n_samp // 2
-        i_end = i_mid + n_samp // 2
+        if i_start < 0:
+            # too short for the window: keep what iloc gives for the whole file
+            return load_emg(csv_path).iloc[i_start:i_end]
+        return load_emg_window(csv_path, i_start, i_end)
 
-        data_dict[ix] = df.iloc[i_start:i_end]
+    data_dict = {}
+    for ix, df in zip(files.index, prefetched(load, files.Path)):
+        data_dict[ix] = df
     
     return data_dict
+
+
+@prof.profiled
+def sample_windows(files, n_sec):
+    '''Stack the centred window of each file into a (n_files, n_samp, 8) array.
+    Files too short to fill the window are left as NaN and flagged in the returned mask.
+    '''
+    n_samp = int(41.7 * n_sec)
+    n_half = n_samp // 2   # same window as sample_data()
+
+    def load(csv_path):
+        i_start, i_end = _centre_window(count_rows(csv_path), n_samp)
+        if i_start < 0:
+            return None
+        return _read_window(csv_path, i_start, i_end)
+
+    arr = np.empty((len(files), 2 * n_half, len(EMG_COLS)))
+    short = np.zeros(len(files), dtype=bool)
+    for i, window in enumerate(prefetched(load, files.Path)):
+        if window is None:
+            arr[i] = np.nan
+            short[i] = True
+        else:
+            arr[i] = window
+
+    return arr, short
+
+
+def segment_data(files, win_sec, hop_sec, max_windows=None):
+    '''Yield (file id, windows, window starts) for each file, where windows is a
+    (n_windows, n_samp, 8) strided view of the whole recording, `hop_sec` apart.
+    With `max_windows`, only that many windows from the middle of the file are kept.
+    Files shorter than one window are skipped.
+    '''
+    n_samp = 2 * (int(41.7 * win_sec) // 2)   # same window as sample_windows()
+    n_hop = max(int(41.7 * hop_sec), 1)
+
+    for ix, x in zip(files.index, prefetched(load_emg_array, files.Path)):
+        windows, starts = sliding_windows(x, n_samp, n_hop, max_windows)
+        if len(windows):
+            yield ix, windows, starts
+
+
+def sliding_windows(x, n_samp, n_hop, max_windows=None):
+    '''Return a read-only (n_windows, n_samp, n_chan) view of the (n_rows, n_chan) array x,
+    with windows starting every n_hop rows, and the start row of each window.
+    No data are copied, so the view is only valid as long as x is.
+    '''
+    n_windows = max((len(x) - n_samp) // n_hop + 1, 0)
+    i_first = 0
+    if max_windows is not None and n_windows > max_windows:
+        i_first = (n_windows - max_windows) // 2 * n_hop
+        n_windows = max_windows
+
+    x = x[i_first:]
+    windows = as_strided(x, shape=(n_windows, n_samp, x.shape[1]),
+                         strides=(n_hop * x.strides[0],) + x.strides,
+                         writeable=False)
+    return windows, i_first + n_hop * np.arange(n_windows)
+
+
+@prof.profiled
+def count_rows(csv_path):
+    '''Number of data rows in csv_path, without parsing it.
+    Taken from the binary cache if set, otherwise by counting lines that are not blank
+    (pd.read_csv skips those). Counts are kept in memory until the file's mtime or
+    size changes.
+    '''
+    if CACHE_DIR:
+        return cache_entry(csv_path)['rows']
+
+    st = os.stat(csv_path)
+    key = os.path.abspath(csv_path)
+    stat_rows = _row_index.get(key)
+    if stat_rows and stat_rows[:2] == (st.st_mtime, st.st_size):
+        return stat_rows[2]
+
+    n_lines = 0
+    tail = b''
+    with io.open(csv_path, 'rb') as f:
+        # blocks of whole lines, so that no blank line is split between two
+        for block in iter(lambda: f.read(1 << 20) + f.readline(), b''):
+            n_lines += block.count(b'\n') - _count_blank(block)
+            tail = block[block.rfind(b'\n') + 1:]
+    if tail.strip():
+        n_lines += 1   # no newline at the end of the last line
+
+    n_rows = max(n_lines - 1, 0)   # minus the header
+    _row_index[key] = (st.st_mtime, st.st_size, n_rows)
+    return n_rows
+
+
+@prof.profiled
+def load_emg_window(csv_path, i_start, i_end):
+    '''Load EMG rows i_start ... i_end - 1 as a data frame, indexed by row number.
+    Only the window is parsed (or copied out of the binary cache).
+    '''
+    _check_ext(csv_path)
+    x = _read_window(csv_path, i_start, i_end)
+    if isinstance(x, pd.DataFrame):
+        x.index = pd.RangeIndex(i_start, i_start + len(x))
+        return x
+
+    dtype = np.int64 if x.dtype.kind in 'iu' else np.float64
+    return pd.DataFrame(x.astype(dtype), columns=EMG_COLS,
+                        index=pd.RangeIndex(i_start, i_start + len(x)))
+
+
+@prof.profiled
+def file_hash(path, blocksize=1 << 20):
+    '''SHA-1 hex digest of the content of a file
+    '''
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+@prof.profiled
+def content_hash(csv_path):
+    '''file_hash() of csv_path, remembered in memory until its mtime or size changes.
+    Taken from the binary cache record if the cache is set.
+    '''
+    if CACHE_DIR:
+        return cache_entry(csv_path)['sha1']
+
+    st = os.stat(csv_path)
+    key = os.path.abspath(csv_path)
+    stat_hash = _hash_index.get(key)
+    if stat_hash and stat_hash[:2] == (st.st_mtime, st.st_size):
+        return stat_hash[2]
+
+    sha1 = file_hash(csv_path)
+    _hash_index[key] = (st.st_mtime, st.st_size, sha1)
+    return sha1
+
+
+@prof.profiled
+def place_file(src, dst, mode='copy'):
+    '''Put a copy of src at dst and return how it was done.
+    With mode 'link', a reflink (copy-on-write clone) and a hard link are tried before
+    falling back to a full copy. Mode 'symlink' also tries a symlink before copying.
+    That one shows the source path, so don't use it where src names must not leak.
+    '''
+    if mode not in ('copy', 'link', 'symlink'):
+        raise ValueError('mode must be "copy", "link" or "symlink", not "%s"' % mode)
+
+    if mode != 'copy':
+        abs_src = os.path.abspath(src)
+        methods = [('reflink', _reflink), ('hardlink', os.link)]
+        if mode == 'symlink':
+            methods.append(('symlink', lambda src, dst: os.symlink(abs_src, dst)))
+
+        for method, place in methods:
+            try:
+                place(src, dst)
+                return method
+            except (OSError, IOError, AttributeError):
+                # not supported here (e.g. across file systems)
+                if os.path.lexists(dst):
+                    os.remove(dst)
+
+    shutil.copy(src, dst)
+    return 'copy'
+
+
+def same_content(path1, path2):
+    '''True if the files are the same file, or have the same size and hash
+    '''
+    if os.path.samefile(path1, path2):
+        return True
+    if os.path.getsize(path1) != os.path.getsize(path2):
+        return False
+    return file_hash(path1) == file_hash(path2)
+
+
+def atomic_write(path, write):
+    '''Write to a temporary file and move it into place, so that concurrent readers
+    (e.g. check_quality workers) never see a partial file
+    '''
+    dirname = os.path.dirname(path)
+    try:
+        os.makedirs(dirname)
+    except OSError:
+        if not os.path.isdir(dirname):
+            raise
+
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        write(f)
+    os.rename(tmp_path, path)
+
+
+def append_features(store_dir, file_ids, feat):
+    '''Save a chunk of features as the next part of the store in store_dir.
+    file_ids are all files of the chunk, including ones that gave no rows.
+    Each part is an .npz with one array per column, so columns can be loaded on their own.
+    '''
+    n_part = max([int(fn[5:10]) + 1 for fn in _feature_parts(store_dir)] or [0])
+    arrays = dict((col, feat[col].values) for col in feat.columns)
+    arrays['_file_ids'] = np.asarray(file_ids)
+    arrays['_index_names'] = np.array([str(name) for name in feat.index.names])
+    for i in range(feat.index.nlevels):
+        arrays['_index%d' % i] = feat.index.get_level_values(i).values
+    arrays['_columns'] = np.array(feat.columns.tolist())
+
+    path = os.path.join(store_dir, 'part-%05d.npz' % n_part)
+    atomic_write(path, lambda f: np.savez(f, **arrays))
+
+
+def stored_file_ids(store_dir):
+    '''Ids of all files already in the feature store in store_dir
+    '''
+    ids = []
+    for fn in _feature_parts(store_dir):
+        with np.load(os.path.join(store_dir, fn), allow_pickle=True) as part:
+            ids.extend(part['_file_ids'].tolist())
+    return ids
+
+
+def load_features(store_dir, columns=None):
+    '''Load the feature store in store_dir as one data frame, optionally only some columns
+    '''
+    dfs = []
+    for fn in _feature_parts(store_dir):
+        with np.load(os.path.join(store_dir, fn), allow_pickle=True) as part:
+            cols = columns or part['_columns'].tolist()
+            names = part['_index_names'].tolist()
+            levels = [part['_index%d' % i] for i in range(len(names))]
+            names = [None if name == 'None' else name for name in names]
+            if len(levels) == 1:
+                index = pd.Index(levels[0], name=names[0])
+            else:
+                index = pd.MultiIndex.from_arrays(levels, names=names)
+            dfs.append(pd.DataFrame(dict((col, part[col]) for col in cols),
+                                    index=index, columns=cols))
+
+    if not dfs:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(dfs)
+
+
+# Helper functions
+###################################################
+
+
+def _parse_name(name, patterns, label_names):
+    for pattern in patterns:
+        labels = pattern.findall(name)
+        if labels:
+            return list(labels[0]), label_names
+    return [None] * len(label_names), label_names
+
+
+def _extract_labels(names, patterns, label_names):
+    '''Match all names against each pattern in turn, as _parse_name() does one name.
+    The names are joined into one string, one per line, and matched by a single
+    findall with the patterns as alternatives, so the matching runs in C.
+    '''
+    names = list(names)
+    n_labels = len(label_names)
+    if any('\n' in name for name in names):
+        raise ValueError('names must not contain line breaks')
+
+    # with the catch-all last, every line gives exactly one match
+    found = _combined_pattern(patterns).findall('\n'.join(names)) if names else []
+    found = np.array(found, dtype=object).reshape(len(names), len(patterns), n_labels)
+
+    # the first group of each pattern is never empty when that pattern matched
+    is_match = found[:, :, 0] != ''
+    i_pattern = is_match.argmax(axis=1)
+    labels = found[np.arange(len(names)), i_pattern]
+    labels[~is_match.any(axis=1)] = None
+
+    return pd.DataFrame(labels, columns=label_names)
+
+
+def _combined_pattern(patterns):
+    key = tuple(p.pattern for p in patterns)
+    if key not in _combined_patterns:
+        alternatives = [p.lstrip('^').rstrip('$') for p in key]
+        _combined_patterns[key] = re.compile('^(?:%s|.*)$' % '|'.join(alternatives),
+                                             re.MULTILINE)
+    return _combined_patterns[key]
+
+
+def _load_emg_values(csv_path):
+    return load_emg(csv_path).values
+
+
+def _check_ext(csv_path):
+    _, ext = os.path.splitext(csv_path)
+    assert ext == '.csv', 'extension must be .csv, not "%s"' % ext
+
+
+def _read_csv_emg(csv_path):
+    df = pd.read_csv(csv_path, header=0, usecols=EMG_COLS)
+    return df.loc[:, EMG_COLS]
+
+
+def _read_window(csv_path, i_start, i_end):
+    '''Rows i_start ... i_end - 1: a slice of the cached memory map, or a data frame
+    parsed after skipping the earlier lines unparsed'''
+    if CACHE_DIR:
+        return _load_cached(csv_path, 'r')[i_start:i_end]
+
+    names = pd.read_csv(csv_path, header=0, nrows=0).columns
+    with io.open(csv_path, 'rb') as f:
+        # skip the header and i_start rows, not counting blank lines as count_rows()
+        for _ in itertools.islice(itertools.ifilter(bytes.strip, f), i_start + 1):
+            pass
+        df = pd.read_csv(f, header=None, names=names, usecols=EMG_COLS,
+                         nrows=i_end - i_start)
+    return df.loc[:, EMG_COLS]
+
+
+def _count_blank(block):
+    '''Number of blank lines in a block of whole lines. The regex only runs if a line
+    starts with whitespace, which data lines don't.
+    '''
+    if block[:1].isspace() or _SPACE_LINE.search(block):
+        return len(_BLANK_LINE.findall(block))
+    return 0
+
+
+def _centre_window(n_rows, n_samp):
+    i_mid = n_rows // 2
+    return i_mid - n_samp // 2, i_mid + n_samp // 2
+
+
+def _load_cached(csv_path, mmap_mode=None):
+    return np.load(_blob_path(cache_entry(csv_path)['sha1']), mmap_mode=mmap_mode)
+
+
+def _blob_path(sha1):
+    return os.path.join(CACHE_DIR, 'blobs', sha1 + '.npy')
+
+
+def _hash_str(s):
+    return hashlib.sha1(s.encode('utf-8')).hexdigest()
+
+
+def _reflink(src, dst):
+    if fcntl is None:
+        raise OSError('reflinks need fcntl')
+
+    with open(src, 'rb') as f_src:
+        fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            fcntl.ioctl(fd, _FICLONE, f_src.fileno())
+        finally:
+            os.close(fd)
+
+
+def _feature_parts(store_dir):
+    if not os.path.isdir(store_dir):
+        return []
+    return sorted(fn for fn in os.listdir(store_dir)
+                  if fn.startswith('part-') and fn.endswith('.npz'))
+
+
+def _compact_dtype(x):
+    '''Smallest little-endian dtype that holds x without loss
+    '''
+    if x.dtype.kind in 'iu':
+        # spikes go up to 65535, so uint16 is tried as well as int16
+        for dtype in ['<i2', '<u2', '<i4']:
+            info = np.iinfo(dtype)
+            if x.size == 0 or (x.min() >= info.min and x.max() <= info.max):
+                return dtype
+        return '<i8'
+    if x.dtype.kind != 'f':
+        raise ValueError('EMG data must be numeric, not %s' % x.dtype)
+
+    x32 = x.astype('<f4')
+    if ((x32 == x) | np.isnan(x)).all():
+        return '<f4'
+    return '<f8'
@@ -0,0 +1,87 @@
+'''Fuzzy matching of hand-typed exercise names to a known list.
+'''
+import os
+import re
+import json
+import difflib
+from collections import defaultdict
+
+CONFIG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'config')
+
+
+def load_exercises(path=os.path.join(CONFIG_DIR, 'exercise-list_short.txt')):
+    '''Load known exercises from a text file (one per line) as a list,
+    or from a json file mapping spellings to exercise names as a dict.
+    '''
+    with open(path) as f:
+        if path.endswith('.json'):
+            return json.load(f)
+        return [line.rstrip() for line in f if line.strip()]
+
+
+def normalize(name):
+    '''Lower case letters only: "Butt Blaster" and "ButtBlaster" are both "buttblaster"
+    '''
+    return re.sub(r'[^a-z]', '', name.lower())
+
+
+class ExerciseMatcher(object):
+    '''Match names to the closest of a list of exercises, like get_best_match().
+    Names are normalized and each distinct name is only matched once. Candidates are
+    shortlisted by shared character trigrams before difflib scores them.
+    `exercises` is a list of names, or a dict mapping spellings to the name returned.
+    '''
+
+    def __init__(self, exercises, cutoff=0.5, normalize=normalize):
+        if not isinstance(exercises, dict):
+            exercises = dict((e, e) for e in exercises)
+        self.cutoff = cutoff
+        self.normalize = normalize
+        self.memo = {}
+
+        # normalized spelling -> exercise name. The first of clashing spellings wins
+        self.targets = {}
+        for spelling in sorted(exercises):
+            self.targets.setdefault(normalize(spelling), exercises[spelling])
+
+        self.ngram_index = defaultdict(set)
+        for key in self.targets:
+            for gram in _trigrams(key):
+                self.ngram_index[gram].add(key)
+
+    def match(self, name):
+        '''Return the exercise closest to name, or None if nothing is close enough
+        '''
+        if name is None or name != name:   # missing or NaN
+            return None
+
+        key = self.normalize(name)
+        if key not in self.memo:
+            self.memo[key] = self._match(key)
+        return self.memo[key]
+
+    def match_series(self, S_names):
+        '''Match a whole column of names at once. Unmatched names become None.
+        '''
+        mapping = dict((name, self.match(name)) for name in S_names.unique())
+        return S_names.map(mapping)
+
+    def _match(self, key):
+        if key in self.targets:
+            return self.targets[key]
+
+        shortlist = set()
+        for gram in _trigrams(key):
+            shortlist |= self.ngram_index.get(gram, set())
+        if not shortlist:
+            shortlist = self.targets
+
+        match = difflib.get_close_matches(key, sorted(shortlist), 1, self.cutoff)
+        if match:
+            return self.targets[match[0]]
+        return None
+
+
+def _trigrams(s):
+    s = '  %s ' % s   # pad, so short names have trigrams too
+    return set(s[i:i + 3] for i in range(len(s) - 2))
@@ -0,0 +1,200 @@
+'''Opt-in instrumentation of the pipeline stages.
+
+The public functions of top_fcns, fileops and calcs are wrapped with @profiled. While
+tracing is on, each call records its wall and cpu time, bytes read, rows processed
+(the length of the table or array it returns), the file it worked on and peak RSS.
+When tracing is off, the wrappers only check a flag.
+
+    with profiling.trace('trace.json'):
+        files_qc = my.check_quality(files)
+        with profiling.stage('training'):
+            svc.fit(X_train, y_train)
+    profiling.summary()
+
+The trace file opens in chrome://tracing or https://ui.perfetto.dev. Calls made in
+worker processes (n_jobs > 1) are not recorded, only the call that started them.
+'''
+from __future__ import division
+
+import os
+import time
+import json
+import functools
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+try:
+    import resource   # for peak memory, unix only
+except ImportError:
+    resource = None
+
+ENABLED = False
+
+_events = []
+
+
+def enable():
+    global ENABLED
+    ENABLED = True
+
+
+def disable():
+    global ENABLED
+    ENABLED = False
+
+
+def reset():
+    '''Forget all recorded calls
+    '''
+    del _events[:]
+
+
+@contextmanager
+def trace(trace_path=''):
+    '''Record calls made inside the block, forgetting earlier ones.
+    Optionally write a Chrome trace at the end.
+    '''
+    reset()
+    was_enabled = ENABLED
+    enable()
+    try:
+        yield
+    finally:
+        if not was_enabled:
+            disable()
+        if trace_path:
+            write_trace(trace_path)
+
+
+@contextmanager
+def stage(name, **args):
+    '''Record the block as a stage of its own, e.g. for model training
+    '''
+    if not ENABLED:
+        yield
+        return
+
+    start = _sample()
+    try:
+        yield
+    finally:
+        _record(name, start, args)
+
+
+def profiled(fcn):
+    '''Decorator recording calls of fcn as stage "<module>.<function>"
+    '''
+    name = '%s.%s' % (fcn.__module__.split('.')[-1], fcn.__name__)
+
+    @functools.wraps(fcn)
+    def wrapper(*args, **kwargs):
+        if not ENABLED:
+            return fcn(*args, **kwargs)
+
+        start = _sample()
+        try:
+            result = fcn(*args, **kwargs)
+        except Exception as e:
+            _record(name, start, {'error': repr(e), 'file': _file_arg(args)})
+            raise
+        _record(name, start, {'file': _file_arg(args), 'rows': _n_rows(result)})
+        return result
+
+    wrapper.__wrapped__ = fcn   # as python 3's functools.wraps sets it
+    return wrapper
+
+
+def events():
+    '''All recorded calls as a data frame, one row per call
+    '''
+    columns = ['name', 'start', 'wall_sec', 'cpu_sec', 'bytes_read', 'rows', 'file',
+               'peak_rss_mb', 'pid', 'tid']
+    return pd.DataFrame(_events, columns=columns)
+
+
+def summary(by='name'):
+    '''Totals per stage (or per file, with by='file'), slowest first.
+    Times are inclusive, so a stage also counts the stages it calls.
+    '''
+    df = events()
+    grouped = df.groupby(by)
+    table = pd.DataFrame({'calls': grouped.size(),
+                          'wall_sec': grouped.wall_sec.sum(),
+                          'cpu_sec': grouped.cpu_sec.sum(),
+                          'bytes_read': grouped.bytes_read.sum(),
+                          'rows': grouped.rows.sum(),
+                          'peak_rss_mb': grouped.peak_rss_mb.max()},
+                         columns=['calls', 'wall_sec', 'cpu_sec', 'bytes_read', 'rows',
+                                  'peak_rss_mb'])
+    return table.sort_values('wall_sec', ascending=False)
+
+
+def write_trace(trace_path):
+    '''Write the recorded calls in the Chrome trace event format
+    '''
+    trace_events = []
+    for e in _events:
+        args = dict((k, e[k]) for k in ['cpu_sec', 'bytes_read', 'rows', 'file',
+                                        'peak_rss_mb', 'error'] if e.get(k) is not None)
+        trace_events.append({'name': e['name'], 'cat': 'athospy', 'ph': 'X',
+                             'ts': e['start'] * 1e6, 'dur': e['wall_sec'] * 1e6,
+                             'pid': e['pid'], 'tid': e['tid'], 'args': args})
+
+    with open(trace_path, 'w') as f:
+        json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, f)
+
+
+# Helper functions
+###################################################
+
+
+def _sample():
+    cpu = os.times()
+    return time.time(), cpu[0] + cpu[1], _bytes_read()
+
+
+def _record(name, start, args):
+    end = _sample()
+    event = {'name': name, 'start': start[0], 'wall_sec': end[0] - start[0],
+             'cpu_sec': end[1] - start[1], 'pid': os.getpid(),
+             'tid': threading.current_thread().ident}
+    if resource is not None:
+        # ru_maxrss is in KB on linux
+        event['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+    if start[2] is not None:
+        event['bytes_read'] = end[2] - start[2]
+    event.update(args)
+    _events.append(event)
+
+
+def _bytes_read():
+    '''Bytes read by this process so far, including from the page cache (linux only)
+    '''
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except IOError:
+        return None
+
+
+def _file_arg(args):
+    if args and isinstance(args[0], basestring) and args[0].endswith('.csv'):
+        return args[0]
+    return None
+
+
+def _n_rows(result):
+    if isinstance(result, tuple) and result:
+        result = result[0]   # e.g. (array, mask) or (spectra, freq, f2)
+    if isinstance(result, (pd.DataFrame, pd.Series, list)):
+        return len(result)
+    if isinstance(result, np.ndarray) and result.ndim > 0:
+        return len(result)
+    if isinstance(result, dict):
+        return result.get('Length', len(result))
+    return None
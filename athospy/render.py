@@ -0,0 +1,132 @@
+'''Headless rendering of EMG recordings to png or pdf, for reviewing many files.
+
+Draws with the Agg canvas directly, without pyplot, so no figures pile up. One figure
+is made per process and reused: each recording only replaces the data of its lines.
+Traces are reduced to the min and max of each pixel column before drawing.
+'''
+from __future__ import division
+
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+import fileops as fop
+
+FS = 41.7
+
+# channels of the two panels, in the order of visualization.plot_emg
+PANELS = [('Right EMG', ['RGM', 'RBF', 'RVM', 'RVL']),
+          ('Left EMG', ['LGM', 'LBF', 'LVM', 'LVL'])]
+
+# the figure of this process, see render_file()
+_renderer = None
+
+
+def minmax_decimate(arr, n_bins):
+    '''Indices of the min and max of each channel in n_bins equal stretches of arr,
+    in time order, as a (2 * n_bins, n_chan) array.
+    Plotting only these points looks the same as plotting all of arr when there are
+    n_bins pixel columns. Short arrays are returned whole.
+    '''
+    arr = np.asarray(arr)
+    n_samp, n_chan = arr.shape
+    if n_samp <= 2 * n_bins:
+        return np.tile(np.arange(n_samp)[:, np.newaxis], (1, n_chan))
+
+    bin_len = n_samp // n_bins
+    starts = np.arange(n_bins) * bin_len
+    binned = arr[:n_bins * bin_len].reshape(n_bins, bin_len, n_chan)
+    i_min = binned.argmin(axis=1) + starts[:, np.newaxis]
+    i_max = binned.argmax(axis=1) + starts[:, np.newaxis]
+
+    # the last bin also takes the samples left over
+    tail = arr[(n_bins - 1) * bin_len:]
+    i_min[-1] = tail.argmin(axis=0) + (n_bins - 1) * bin_len
+    i_max[-1] = tail.argmax(axis=0) + (n_bins - 1) * bin_len
+
+    ix = np.empty((n_bins, 2, n_chan), dtype=np.intp)
+    ix[:, 0] = np.minimum(i_min, i_max)
+    ix[:, 1] = np.maximum(i_min, i_max)
+    return ix.reshape(2 * n_bins, n_chan)
+
+
+class EMGRenderer(object):
+    '''A two-panel EMG figure like visualization.plot_emg, drawn again for each recording
+    '''
+
+    def __init__(self, figsize=(16, 4), dpi=100):
+        self.fig = Figure(figsize=figsize, dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.fig)
+        self.title = self.fig.suptitle('')
+
+        self.axes, self.lines, self.cols = [], [], []
+        for i, (ylabel, cols) in enumerate(PANELS):
+            ax = self.fig.add_subplot(2, 1, i + 1, sharex=self.axes[0] if i else None)
+            for col in cols:
+                self.lines.append(ax.plot([], [], label=col)[0])
+            ax.legend(loc='center left', bbox_to_anchor=(1, 0.5))
+            ax.set_ylabel(ylabel)
+            self.axes.append(ax)
+            self.cols.extend(cols)
+        self.axes[-1].set_xlabel('time [sec]')
+
+        self.i_cols = [fop.EMG_COLS.index(col) for col in self.cols]
+
+    def n_pixels(self):
+        '''Width of the plotting area in pixels
+        '''
+        return int(np.ceil(self.fig.get_figwidth() * self.fig.dpi *
+                           self.axes[0].get_position().width))
+
+    def decimate(self, arr):
+        '''(t, y) of each line for the (n_samp, 8) EMG array arr
+        '''
+        arr = np.asarray(arr)[:, self.i_cols]
+        n_samp = len(arr)
+        t = np.linspace(0, n_samp / FS, n_samp)
+        ix = minmax_decimate(arr, self.n_pixels())
+        return [(t[ix[:, j]], arr[ix[:, j], j]) for j in range(arr.shape[1])]
+
+    def draw(self, lines, title=''):
+        '''Show lines, as returned by decimate()
+        '''
+        for line, (t, y) in zip(self.lines, lines):
+            line.set_data(t, y)
+        for ax in self.axes:
+            ax.relim()
+            ax.autoscale_view()
+        self.title.set_text(title)
+
+    def save(self, path_or_pages):
+        '''Save to a file, or as the next page of a PdfPages
+        '''
+        if hasattr(path_or_pages, 'savefig'):
+            path_or_pages.savefig(self.fig)
+        else:
+            self.fig.savefig(path_or_pages)
+
+
+def decimated(csv_path):
+    '''Load csv_path and decimate it for the renderer of this process
+    '''
+    return _get_renderer().decimate(fop.load_emg_array(csv_path))
+
+
+def render_file(csv_path, out_path, title=''):
+    '''Render csv_path to out_path (png, pdf, ... by extension) with this process' figure
+    '''
+    renderer = _get_renderer()
+    renderer.draw(renderer.decimate(fop.load_emg_array(csv_path)), title)
+    renderer.save(out_path)
+    return out_path
+
+
+# Helper functions
+###################################################
+
+
+def _get_renderer():
+    global _renderer
+    if _renderer is None:
+        _renderer = EMGRenderer()
+    return _renderer
@@ -0,0 +1,302 @@
+'''Local inference service: classify recordings with a saved model, kept in memory.
+
+    python athospy/serve.py model.pkl --port 8000
+    python athospy/serve.py model.pkl --predict a.csv b.csv
+
+The model file is written by training.save_model(). The server takes POST /predict
+with a json body {"items": [...]}, where each item is the path of a csv recording or
+a list of 8-channel frames (in the order of fileops.EMG_COLS), and answers with
+{"labels": [...], "errors": [...]}. GET /stats returns latency and throughput.
+Requests that arrive together are classified together, in micro-batches.
+'''
+from __future__ import division
+
+import json
+import time
+import urllib2
+import argparse
+import threading
+import Queue
+import BaseHTTPServer
+import SocketServer
+from collections import deque
+import numpy as np
+import pandas as pd
+
+# athospy packages
+import calcs as clc
+import fileops as fop
+import top_fcns as my
+import training as trn
+
+
+class InferenceService(object):
+    '''Classify recordings with a model and scaler loaded once from model_path.
+    Items passed to submit() from any number of threads are gathered into batches of
+    up to max_batch, waiting at most max_wait seconds for a batch to fill, and their
+    features are calculated and classified together as in get_features().
+    n_sec, max_lag and nperseg default to those saved with the model, if any, and
+    robust is always the saved one. A ValueError is raised if n_sec is neither given
+    nor saved, as features of another window size would classify wrongly.
+    '''
+
+    def __init__(self, model_path, n_sec=None, max_lag=None, nperseg=None, max_batch=32,
+                 max_wait=0.01, n_latencies=10000):
+        bundle = trn.load_model(model_path)
+        self.model = bundle['model']
+        self.scaler = bundle['scaler']
+        self.n_sec = n_sec if n_sec is not None else bundle.get('n_sec')
+        if self.n_sec is None:
+            raise ValueError('no n_sec saved with the model in "%s", pass the window it '
+                             'was trained with' % model_path)
+        self.max_lag = max_lag if max_lag is not None else bundle.get('max_lag')
+        self.nperseg = nperseg if nperseg is not None else bundle.get('nperseg')
+        self.robust = bundle.get('robust', False)
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+
+        self.latencies = deque(maxlen=n_latencies)
+        self.n_done = 0
+        self.n_batches = 0
+        self.t_start = time.time()
+
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._worker = threading.Thread(target=self._run)
+        self._worker.daemon = True
+        self._worker.start()
+
+    def submit(self, item):
+        '''Queue a csv path or (n_samp, 8) array, and return a Request whose wait()
+        returns the label
+        '''
+        request = Request(item)
+        self._queue.put(request)
+        return request
+
+    def predict(self, items):
+        '''Labels of a list of items, or an exception in place of each one that failed
+        '''
+        requests = [self.submit(item) for item in items]
+        return [request.wait() for request in requests]
+
+    def stats(self):
+        '''Latency percentiles [ms] of the recent requests, and overall throughput
+        '''
+        with self._lock:
+            latencies = np.array(self.latencies)
+            n_done, n_batches = self.n_done, self.n_batches
+        elapsed = time.time() - self.t_start
+
+        p50, p99 = np.percentile(latencies, [50, 99]) * 1e3 if len(latencies) else (None, None)
+        return {'requests': n_done, 'batches': n_batches,
+                'mean_batch': n_done / n_batches if n_batches else None,
+                'p50_ms': p50, 'p99_ms': p99,
+                'requests_per_sec': n_done / elapsed if elapsed else None}
+
+    def close(self):
+        self._queue.put(None)
+        self._worker.join()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            if batch[0] is None:
+                return
+
+            deadline = time.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                try:
+                    request = self._queue.get(timeout=max(deadline - time.time(), 0))
+                except Queue.Empty:
+                    break
+                if request is None:
+                    self._queue.put(None)   # stop after this batch
+                    break
+                batch.append(request)
+
+            self._classify(batch)
+
+    def _classify(self, batch):
+        try:
+            labels = self._predict([request.item for request in batch])
+        except Exception:
+            # find the items that fail, and classify the others one by one
+            labels = []
+            for request in batch:
+                try:
+                    labels.append(self._predict([request.item])[0])
+                except Exception as e:
+                    labels.append(e)
+
+        t_done = time.time()
+        with self._lock:
+            for request, label in zip(batch, labels):
+                request._set(label)
+                self.latencies.append(t_done - request.t_submit)
+            self.n_done += len(batch)
+            self.n_batches += 1
+
+    def _predict(self, items):
+        feat = self._features(items)
+        if self.scaler is not None:
+            feat = self.scaler.transform(feat)
+        return list(self.model.predict(feat))
+
+    def _features(self, items):
+        '''Feature rows of the items, in order: files through get_features(), arrays
+        by their centred window
+        '''
+        is_path = np.array([isinstance(item, basestring) for item in items], dtype=bool)
+        feat = np.empty((len(items), len(fop.EMG_COLS) * 2 + 2))
+
+        if is_path.any():
+            paths = [item for item in items if isinstance(item, basestring)]
+            files = pd.DataFrame({'Path': paths})
+            feat[is_path] = my.get_features(files, self.n_sec, max_lag=self.max_lag,
+                                            nperseg=self.nperseg, robust=self.robust).values
+        if not is_path.all():
+            windows = [_centred(np.asarray(item, dtype=np.float64), self.n_sec)
+                       for item in items if not isinstance(item, basestring)]
+            feat[~is_path] = clc.features_batch(np.array(windows), self.max_lag, self.nperseg,
+                                                self.robust)
+
+        return feat
+
+
+class Request(object):
+    '''An item waiting to be classified
+    '''
+
+    def __init__(self, item):
+        self.item = item
+        self.t_submit = time.time()
+        self._done = threading.Event()
+        self._label = None
+
+    def wait(self, timeout=None):
+        '''Wait for the label. Returns the exception instead, if the item failed.
+        '''
+        self._done.wait(timeout)
+        return self._label
+
+    def _set(self, label):
+        self._label = label
+        self._done.set()
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''HTTP server for an InferenceService, with a thread per connection
+    '''
+    daemon_threads = True
+
+    def __init__(self, service, address=('127.0.0.1', 8000)):
+        BaseHTTPServer.HTTPServer.__init__(self, address, Handler)
+        self.service = service
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != '/stats':
+            return self._reply(404, {'error': 'unknown path %s' % self.path})
+        self._reply(200, self.server.service.stats())
+
+    def do_POST(self):
+        if self.path != '/predict':
+            return self._reply(404, {'error': 'unknown path %s' % self.path})
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.getheader('content-length'))))
+            items = body['items']
+        except (TypeError, ValueError, KeyError):
+            return self._reply(400, {'error': 'expected a json body {"items": [...]}'})
+
+        results = self.server.service.predict(items)
+        errors = [repr(r) if isinstance(r, Exception) else None for r in results]
+        labels = [None if e else _to_json(r) for r, e in zip(results, errors)]
+        self._reply(200, {'labels': labels, 'errors': errors})
+
+    def _reply(self, status, obj):
+        body = json.dumps(obj)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass   # one line per request is too much at any useful rate
+
+
+def post(url, items, timeout=60):
+    '''Send items to the /predict url of a running server, and return its answer
+    '''
+    request = urllib2.Request(url, json.dumps({'items': items}),
+                              {'Content-Type': 'application/json'})
+    return json.loads(urllib2.urlopen(request, timeout=timeout).read())
+
+
+# Helper functions
+###################################################
+
+
+def _centred(x, n_sec):
+    '''Centred window of n_sec of the (n_samp, 8) array x, as in fileops.sample_windows()
+    '''
+    n_half = int(41.7 * n_sec) // 2
+    i_mid = len(x) // 2
+    if x.ndim != 2 or x.shape[1] != len(fop.EMG_COLS):
+        raise ValueError('expected frames of %d channels' % len(fop.EMG_COLS))
+    if i_mid < n_half:
+        raise ValueError('recording of %d frames is shorter than the %d of the window'
+                         % (len(x), 2 * n_half))
+    return x[i_mid - n_half:i_mid + n_half]
+
+
+def _to_json(label):
+    return label.item() if isinstance(label, np.generic) else label
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('model', help='model file from training.save_model()')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--n-sec', type=float, help='feature window [sec]')
+    parser.add_argument('--max-batch', type=int, default=32)
+    parser.add_argument('--max-wait-ms', type=float, default=10,
+                        help='longest wait for a batch to fill')
+    parser.add_argument('--cache', help='load recordings through a binary cache here')
+    parser.add_argument('--prefetch', type=int, default=0, help='reader threads')
+    parser.add_argument('--predict', nargs='+', metavar='CSV',
+                        help='classify these files and exit, instead of serving')
+    args = parser.parse_args(argv)
+
+    if args.cache:
+        fop.set_cache_dir(args.cache)
+    fop.set_prefetch(args.prefetch)
+
+    t_start = time.time()
+    service = InferenceService(args.model, args.n_sec, max_batch=args.max_batch,
+                               max_wait=args.max_wait_ms / 1e3)
+    print 'loaded "%s" in %.2f s' % (args.model, time.time() - t_start)
+
+    if args.predict:
+        for csv_path, label in zip(args.predict, service.predict(args.predict)):
+            print '%s\t%s' % (csv_path, label)
+        print json.dumps(service.stats())
+        return
+
+    server = Server(service, (args.host, args.port))
+    print 'serving on http://%s:%d (POST /predict, GET /stats)' % server.server_address
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+'''Real-time activity classification over a live stream of EMG frames.
+'''
+from __future__ import division
+
+import time
+import numpy as np
+import pandas as pd
+
+# athospy packages
+import calcs as clc
+import fileops as fop
+
+FS = 41.7   # EMG sampling rate [Hz]
+
+
+class StreamClassifier(object):
+    '''Classify a live stream of 8-channel EMG frames (in the order of fileops.EMG_COLS).
+    The last n_sec of frames are kept in a ring buffer. Once it is full, a label is
+    predicted with `model` every hop_sec, from the same features as get_features().
+    A fitted `scaler` (with a transform method) is applied to the features first, if given.
+
+    The spectrum is kept up to date with a sliding DFT, which costs one
+    (n_freq x n_hop) product per hop instead of a full FFT. It is recomputed from
+    scratch every `resync` hops so rounding errors don't build up.
+    '''
+
+    def __init__(self, model, n_sec, hop_sec, scaler=None, max_lag=None, resync=100):
+        self.model = model
+        self.scaler = scaler
+        self.max_lag = max_lag
+        self.resync = resync
+
+        self.n_samp = 2 * (int(FS * n_sec) // 2)   # same window as get_features()
+        self.n_hop = max(int(FS * hop_sec), 1)
+        if self.n_hop > self.n_samp:
+            raise ValueError('hop_sec must not be longer than n_sec')
+
+        # zero-padding to 2 * n_samp makes the circular xcorr exact for all the phase
+        # lags, and its even bins are the unpadded spectrum used for the frequencies
+        self.nfft = 2 * self.n_samp
+        self.freq = np.fft.rfftfreq(self.n_samp, d=1. / FS)
+        self.lags = clc.lag_range(self.n_samp, max_lag)
+
+        k = np.arange(self.nfft // 2 + 1)[:, np.newaxis]
+        i_old = np.arange(self.n_hop)
+        i_new = np.arange(self.n_samp - self.n_hop, self.n_samp)
+        self._rot = np.exp(2j * np.pi * k * self.n_hop / self.nfft)
+        self._twiddle_old = np.exp(-2j * np.pi * k * i_old / self.nfft)
+        self._twiddle_new = np.exp(-2j * np.pi * k * i_new / self.nfft)
+
+        self.reset()
+
+    def reset(self):
+        '''Forget all frames, e.g. at the start of a new recording
+        '''
+        self._buf = np.zeros((self.n_samp, len(fop.EMG_COLS)))
+        self._pos = 0       # ring buffer index of the oldest frame
+        self._n_seen = 0
+        self._n_hops = 0
+        self._pending = []  # frames since the last hop
+        self._spec = None
+
+    def window(self):
+        '''The frames in the ring buffer, oldest first
+        '''
+        return np.concatenate((self._buf[self._pos:], self._buf[:self._pos]))
+
+    def push(self, frame):
+        '''Add one frame. Return the predicted label if a hop was completed, else None.
+        '''
+        if self._n_seen < self.n_samp:
+            self._buf[self._n_seen] = frame
+            self._n_seen += 1
+            if self._n_seen < self.n_samp:
+                return None
+            self._spec = np.fft.rfft(self._buf, n=self.nfft, axis=0)
+            return self.predict()
+
+        self._pending.append(frame)
+        if len(self._pending) < self.n_hop:
+            return None
+
+        self._advance(np.array(self._pending))
+        self._pending = []
+        return self.predict()
+
+    def features(self):
+        '''Feature row for the current window, in the columns of get_features()
+        '''
+        spec = self._spec[np.newaxis]
+
+        f2 = clc.top_freqs(np.abs(spec[:, ::2]), self.freq)
+        peaks = clc.meanpeaks_batch(self.window()[np.newaxis], 0.5)
+        xcorr, lags = clc.xcorr_spec(spec, self.nfft, *self.lags)
+        phase = -lags[xcorr.argmax(axis=1)]
+
+        return np.concatenate((peaks, f2[:, ::-1], phase), axis=1)[0]
+
+    def predict(self):
+        feat = self.features()[np.newaxis]
+        if self.scaler is not None:
+            feat = self.scaler.transform(feat)
+        return self.model.predict(feat)[0]
+
+    def _advance(self, new):
+        '''Shift the window by len(new) == n_hop frames and update its spectrum
+        '''
+        i_old = (self._pos + np.arange(self.n_hop)) % self.n_samp
+        old = self._buf[i_old]
+
+        self._buf[i_old] = new
+        self._pos = (self._pos + self.n_hop) % self.n_samp
+        self._n_hops += 1
+
+        if self.resync and self._n_hops % self.resync == 0:
+            self._spec = np.fft.rfft(self.window(), n=self.nfft, axis=0)
+        else:
+            self._spec = (self._rot * (self._spec - self._twiddle_old.dot(old)) +
+                          self._twiddle_new.dot(new))
+
+
+def classify_stream(classifier, frames):
+    '''Feed frames to the classifier and yield (frame number, label, latency [s]) per hop.
+    Latency is the time from receiving the hop's last frame until its label is ready.
+    '''
+    for i, frame in enumerate(frames):
+        t_in = time.time()
+        label = classifier.push(frame)
+        if label is not None:
+            yield i, label, time.time() - t_in
+
+
+def replay_csv(csv_path, speed=1.):
+    '''Yield the frames of a recording as a live source would, at `speed` times
+    real time. A speed of None replays as fast as possible.
+    '''
+    x = fop.load_emg_array(csv_path)
+
+    t_start = time.time()
+    for i in range(len(x)):
+        if speed:
+            delay = t_start + i / (FS * speed) - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        yield x[i]
+
+
+def socket_frames(sock, n_chan=8, bufsize=4096):
+    '''Yield frames from a socket-like object (anything with recv) that sends
+    little-endian float32 frames of n_chan values. Stops when the sender closes.
+    '''
+    frame_size = 4 * n_chan
+    data = b''
+    while True:
+        chunk = sock.recv(bufsize)
+        if not chunk:
+            return
+        data += chunk
+
+        n_bytes = len(data) // frame_size * frame_size
+        for frame in np.frombuffer(data[:n_bytes], dtype='<f4').reshape(-1, n_chan):
+            yield frame
+        data = data[n_bytes:]
+
+
+def replay_latency(classifier, files, speed=None):
+    '''Replay each file in files.Path through the classifier and return a data frame
+    with the label and end-to-end latency of every prediction.
+    '''
+    rows = []
+    for ix, csv_path in zip(files.index, files.Path):
+        classifier.reset()
+        frames = replay_csv(csv_path, speed)
+        for i, label, latency in classify_stream(classifier, frames):
+            rows.append((ix, i, label, latency))
+
+    return pd.DataFrame(rows, columns=['File_id', 'Frame', 'Label', 'Latency'])
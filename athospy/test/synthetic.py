@@ -0,0 +1,94 @@
+'''Small synthetic corpus for the tests, with the inputs that the fast paths have to
+handle like the pandas ones: missing values, a file shorter than the window, and
+blank lines in the csv.
+'''
+from __future__ import division
+
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+sys.path.insert(0, os.path.join(REPO_DIR, 'benchmarks'))
+
+import bench_pipeline as bp
+import athospy.calcs as clc
+import athospy.fileops as fop
+
+N_SEC = 5
+FS = 41.7
+
+# file ids of the special files
+NAN_ID, SHORT_ID, BLANK_ID = 100, 101, 102
+
+
+def make_files(dirpath, n_files=6, rec_sec=20, seed=0):
+    '''Write the corpus to dirpath and return its file table. The files after the
+    n_files regular ones are:
+    * NAN_ID - file 1 with missing values, also in its centre window
+    * SHORT_ID - 100 rows of file 2, shorter than the N_SEC window
+    * BLANK_ID - file 0 with blank lines at the start, in the middle and at the end
+    '''
+    files = bp.make_corpus(dirpath, n_files, rec_sec, seed)
+
+    df = fop.load_emg(files.Path[1]).astype(np.float64)
+    df = df.mask(np.random.RandomState(seed).rand(*df.shape) < 0.01)
+    df.iloc[len(df) // 2, 3] = np.nan
+    nan_path = _write(dirpath, 'nan', df)
+
+    short_path = _write(dirpath, 'short', fop.load_emg(files.Path[2]).iloc[:100])
+
+    with open(files.Path[0], 'rb') as f:
+        lines = f.read().split(b'\n')
+    i_mid = len(lines) // 2
+    blank_path = os.path.join(dirpath, 'blank.csv')
+    with open(blank_path, 'wb') as f:
+        f.write(b'\n'.join([b''] + lines[:i_mid] + [b'', b'  '] + lines[i_mid:] + [b'\n\n']))
+
+    extra = pd.DataFrame([(10, 'Squat', path) for path in [nan_path, short_path, blank_path]],
+                         columns=files.columns, index=[NAN_ID, SHORT_ID, BLANK_ID])
+    return pd.concat([files, extra])
+
+
+def reference_features(csv_path, n_sec=N_SEC, max_lag=None):
+    '''Feature row of the centred window, from the full pandas parse and the
+    per-DataFrame functions of calcs, as get_features() did one file at a time
+    '''
+    df = fop.load_emg(csv_path)
+    n_half = int(FS * n_sec) // 2
+    i_mid = len(df) // 2
+    return reference_row(df.iloc[i_mid - n_half:i_mid + n_half], max_lag)
+
+
+def reference_row(window, max_lag=None):
+    _, _, fc = clc.fft_df(window)
+    return np.concatenate((clc.meanpeaks_df(window, 0.5), fc[::-1],
+                           clc.phase_df(window, max_lag=max_lag)))
+
+
+def reference_quality(csv_path):
+    '''Quality metrics of calcs.quality() as they were computed with data frames
+    '''
+    df = fop.load_emg(csv_path)
+    len_df = len(df)
+    return {
+        "Length": len_df,
+        "Max": df[df < 15000].unstack().max(),
+        "Median": df.unstack().median(),
+        "N_spikes": (df > 65000).sum().sum(),
+        "MaxFrac_zero": max((df == 0).sum().divide(len_df) * 100),
+        "MaxFrac_repeat": max(((df > 100) & (df.diff() == 0)).sum().divide(len_df) * 100)
+    }
+
+
+# Helper functions
+###################################################
+
+
+def _write(dirpath, name, df):
+    df = df.reset_index(drop=True)
+    df.insert(0, 'Time', np.round(np.arange(len(df)) / FS, 3))
+    path = os.path.join(dirpath, '%s.csv' % name)
+    df.to_csv(path, index=False)
+    return path
@@ -0,0 +1,34 @@
+'''Batch calculations of calcs against the library functions they reproduce
+'''
+from __future__ import division
+
+import unittest
+import numpy as np
+from numpy.testing import assert_allclose
+from scipy import signal
+
+import athospy.calcs as clc
+
+
+class TestWelch(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        t = np.arange(417) / 41.7
+        self.arr = (np.sin(2 * np.pi * np.outer([1.5, 3.], t))[:, :, np.newaxis] +
+                    rng.randn(2, 417, 8))
+
+    def test_scipy_welch(self):
+        for nperseg in [32, 64, 127, 128, 201, 417]:
+            psd, freq, _ = clc.welch_batch(self.arr, nperseg)
+            f_ref, psd_ref = signal.welch(self.arr, fs=41.7, nperseg=nperseg, axis=1)
+            assert_allclose(freq, f_ref, err_msg='nperseg %d' % nperseg)
+            assert_allclose(psd, psd_ref, rtol=1e-9, err_msg='nperseg %d' % nperseg)
+
+    def test_top_freqs(self):
+        _, freq, f2 = clc.welch_batch(self.arr, 128)
+        assert_allclose(f2[:, 0], [1.5, 3.], atol=freq[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
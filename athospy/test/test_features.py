@@ -0,0 +1,119 @@
+'''get_features() against the per-DataFrame reference, through each of its paths
+'''
+from __future__ import division
+
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from numpy.testing import assert_allclose, assert_array_equal
+
+import athospy.calcs as clc
+import athospy.fileops as fop
+import athospy.featcache as fc
+import athospy.top_fcns as my
+from athospy.test import synthetic as syn
+
+
+class TestFeatures(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp(prefix='athospy_test_')
+        cls.files = syn.make_files(cls.tmp_dir)
+        cls.reference = np.array([syn.reference_features(path) for path in cls.files.Path])
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_dir, ignore_errors=True)
+
+    def test_centred_window(self):
+        feat = my.get_features(self.files, syn.N_SEC)
+        self.assertEqual(feat.columns.tolist(), my._feature_columns())
+        assert_array_equal(feat.index, self.files.index)
+        assert_allclose(feat.values, self.reference, rtol=1e-9)
+
+    def test_blank_lines(self):
+        self.assertEqual(fop.count_rows(self.files.Path[syn.BLANK_ID]),
+                         fop.count_rows(self.files.Path[0]))
+        feat = my.get_features(self.files.loc[[0, syn.BLANK_ID]], syn.N_SEC)
+        assert_array_equal(feat.values[0], feat.values[1])
+
+    def test_max_lag(self):
+        feat = my.get_features(self.files, syn.N_SEC, max_lag=20)
+        reference = [syn.reference_features(path, max_lag=20) for path in self.files.Path]
+        assert_allclose(feat.values, reference, rtol=1e-9)
+
+    def test_binary_cache(self):
+        fop.set_cache_dir(tempfile.mkdtemp(dir=self.tmp_dir))
+        try:
+            feat = my.get_features(self.files, syn.N_SEC)
+        finally:
+            fop.set_cache_dir('')
+        assert_allclose(feat.values, self.reference, rtol=1e-9)
+
+    def test_hop_windows(self):
+        n_samp = 2 * (int(syn.FS * syn.N_SEC) // 2)
+        feat = my.get_features(self.files, syn.N_SEC, hop_sec=2)
+
+        for ix, path in zip(self.files.index, self.files.Path):
+            df = fop.load_emg(path)
+            starts = np.arange(0, len(df) - n_samp + 1, int(syn.FS * 2))
+            if not len(starts):
+                self.assertNotIn(ix, feat.index.get_level_values(0))
+                continue
+
+            rows = feat.xs(ix, level=0)
+            assert_array_equal(rows.index, starts)
+            for i_start in starts[[0, -1]]:
+                reference = syn.reference_row(df.iloc[i_start:i_start + n_samp])
+                assert_allclose(rows.loc[i_start], reference, rtol=1e-9)
+
+    def test_chunks(self):
+        arr, short = fop.sample_windows(self.files, syn.N_SEC)
+        arr = arr[~short]
+        assert_array_equal(clc.features_batch(arr, chunksize=2), clc.features_batch(arr))
+        assert_array_equal(clc.features_batch(arr, robust=True, chunksize=2),
+                           clc.features_batch(arr, robust=True))
+        assert_allclose(clc.meanpeaks_batch(arr, 0.5), clc.features_batch(arr)[:, :8])
+
+    def test_robust_dropout(self):
+        # a channel over half at zero has a MAD of 0, a constant one no spread at all
+        rng = np.random.RandomState(0)
+        x = rng.gamma(2, 50, (2, 208, 8)) + 1000 * (rng.rand(2, 208, 8) < 0.1)
+        x[0, :115, 2] = 0
+        x[1, :, 5] = 300
+        peaks = clc.meanpeaks_batch(x, 0.5, robust=True)
+        self.assertTrue(np.isfinite(peaks).all())
+        assert_allclose(peaks[1, 5], 300)
+        assert_array_equal(clc.features_batch(x, robust=True)[:, :8], peaks)
+
+    def test_chunked_store(self):
+        store_dir = tempfile.mkdtemp(dir=self.tmp_dir)
+        n_done = my.get_features_chunked(self.files.iloc[:3], syn.N_SEC, store_dir, chunksize=2)
+        self.assertEqual(n_done, 3)
+
+        # a restarted run only does the files that are missing
+        n_done = my.get_features_chunked(self.files, syn.N_SEC, store_dir, chunksize=2)
+        self.assertEqual(n_done, len(self.files) - 3)
+
+        feat = fop.load_features(store_dir).loc[self.files.index]
+        assert_allclose(feat.values, self.reference, rtol=1e-9)
+
+    def test_feature_cache(self):
+        cache = fc.FeatureCache(tempfile.mkdtemp(dir=self.tmp_dir))
+        first = my.get_features(self.files, syn.N_SEC, cache=cache)
+        self.assertEqual((cache.hits, cache.misses), (0, len(self.files)))
+
+        second = my.get_features(self.files, syn.N_SEC, cache=cache)
+        self.assertEqual(cache.hits, len(self.files))
+        assert_allclose(first.values, self.reference, rtol=1e-9)
+        assert_array_equal(second.values, first.values)
+
+        # other parameters are other entries
+        my.get_features(self.files, syn.N_SEC, cache=cache, robust=True)
+        self.assertEqual(cache.misses, 2 * len(self.files))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+'''check_quality() against the quality metrics computed with data frames
+'''
+from __future__ import division
+
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+from numpy.testing import assert_allclose
+
+import athospy.calcs as clc
+import athospy.top_fcns as my
+from athospy.test import synthetic as syn
+
+
+class TestQuality(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp(prefix='athospy_test_')
+        cls.files = syn.make_files(cls.tmp_dir)
+        cls.reference = pd.DataFrame([syn.reference_quality(path) for path in cls.files.Path],
+                                     index=cls.files.index)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_dir, ignore_errors=True)
+
+    def assert_same(self, df_quality):
+        df_quality = df_quality[self.reference.columns]
+        assert_allclose(df_quality.values.astype(float), self.reference.values.astype(float))
+
+    def test_check_quality(self):
+        self.assert_same(my.check_quality(self.files, plot_on=False))
+
+    def test_processes(self):
+        self.assert_same(my.check_quality(self.files, n_jobs=2, plot_on=False))
+
+    def test_stats(self):
+        df_quality = my.check_quality(self.files, plot_on=False, stats=True)
+        self.assert_same(df_quality)
+        self.assertIn('f1', df_quality.columns)
+
+    def test_missing_values(self):
+        # one missing sample must not make the median missing
+        self.assertFalse(np.isnan(self.reference.Median[syn.NAN_ID]))
+        x = np.arange(100, 900, dtype=np.float64).reshape(100, 8)
+        x[5, 3] = np.nan
+        self.assertEqual(clc.quality_arr(x)['Median'], np.nanmedian(x))
+
+    def test_empty(self):
+        quality = clc.quality_arr(np.empty((0, 8)))
+        self.assertEqual(quality['Length'], 0)
+        self.assertTrue(np.isnan(quality['Median']))
+
+
+if __name__ == '__main__':
+    unittest.main()
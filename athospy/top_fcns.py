@@ -5,80 +5,111 @@ import pandas as pd
 import fnmatch
 import difflib
 import shutil
+import hashlib
+import itertools
 import numpy as np
+import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
 
-# athospy packages
-import visualization as viz
+# athospy packages. visualization (pyplot, seaborn) and sklearn are imported in the
+# functions that use them, so headless feature extraction doesn't pay for them
 import calcs as clc
 import fileops as fop
+import profiling as prof
 
-# ML
-from sklearn import svm, metrics
+# metrics of calcs.quality(), which check_quality plots
+_QC_COLS = ['Length', 'Max', 'Median', 'N_spikes', 'MaxFrac_zero', 'MaxFrac_repeat']
 
 
-
-def label_folders(basepath, write_dst):
+@prof.profiled
+def label_folders(basepath, write_dst, index=None, compact=False):
     '''Return dataframe containing labels parsed from sub-folders directly under basepath.
     Write a record of what was done to disk.
+    With a corpus.CorpusIndex as `index`, only new folders are parsed.
+    With `compact`, labels are stored as categoricals (see fileops.compact_labels).
     '''
-    folder_labels = []
-    paths = []
-    for fname in os.listdir(basepath):
-        path = os.path.join(basepath, fname)
-        if os.path.isdir(path) and fname[0] != '.':
-            paths.append(path)
-            labels, names = fop.parse_folder_name(fname)
-            folder_labels.append(labels)
-
-    df = _to_dataframe(folder_labels, names)
-    df['Path'] = paths
+    if index is not None:
+        fnames = [name for name, is_dir, _ in index.listdir(basepath)
+                  if is_dir and name[0] != '.']
+        parsed = index.parse_names(basepath, fnames, fop.parse_folder_name)
+        df = pd.DataFrame([labels for labels, _ in parsed], columns=fop.FOLDER_LABELS)
+    else:
+        fnames = [fname for fname in os.listdir(basepath)
+                  if os.path.isdir(os.path.join(basepath, fname)) and fname[0] != '.']
+        df = fop.parse_folder_names(fnames)
+
+    df['Path'] = [os.path.join(basepath, fname) for fname in fnames]
     df['Person_id'] = _name_to_id(df.First_Last)
+    if compact:
+        df = fop.compact_labels(df)
     return _select_parsed(df, write_dst)
 
 
-def label_csvfiles_by_folder(basepath, df_folders, write_dst):
+@prof.profiled
+def label_csvfiles_by_folder(basepath, df_folders, write_dst, index=None, compact=False):
     '''Return dataframe for all csv files under basepath, with a column for folder ids
     Write a record of what was done to disk.
+    With a corpus.CorpusIndex as `index`, only changed directories are re-listed.
+    With `compact`, labels are stored as categoricals (see fileops.compact_labels).
     '''
     # create table for all csv-files
     subdir__ix = zip(df_folders.Path, df_folders.index)
-    df_list = [label_csvfiles(subdir, ix) for subdir, ix in subdir__ix]
+    df_list = [label_csvfiles(subdir, ix, index) for subdir, ix in subdir__ix]
     # concatenate data frames for all subdirectoriees
     files = pd.concat(df_list, ignore_index=True)
+    if compact:
+        files = fop.compact_labels(files)
     return _select_parsed(files, write_dst)
 
 
-def label_csvfiles(basepath, id=-1):
+@prof.profiled
+def label_csvfiles(basepath, id=-1, index=None):
     '''Return dataframe containing labels parsed from all csv files under basepath (recursively).
     Also append an id to index the top-level folder from which the csv files came
+    With a corpus.CorpusIndex as `index`, only changed directories are re-listed.
+    Otherwise all names are parsed at once, see fileops.parse_csv_names.
     '''
+    walk = index.walk if index is not None else os.walk
+
     file_labels = []
+    fnames_all = []
     paths = []
-    for root, dirnames, fnames in os.walk(basepath):
-        for fn in fnmatch.filter(fnames, '*.csv'):
-            paths.append(os.path.join(root, fn))
-            labels, names = fop.parse_csv_name(fn)
-            file_labels.append(labels)
+    for root, dirnames, fnames in walk(basepath):
+        fnames = fnmatch.filter(fnames, '*.csv')
+        if index is not None:
+            parsed = index.parse_names(root, fnames, fop.parse_csv_name)
+            file_labels.extend(labels for labels, _ in parsed)
+
+        fnames_all.extend(fnames)
+        paths.extend(os.path.join(root, fn) for fn in fnames)
 
-    df = _to_dataframe(file_labels, names)
+    if index is not None:
+        df = pd.DataFrame(file_labels, columns=fop.CSV_LABELS)
+    else:
+        df = fop.parse_csv_names(fnames_all)
     df['Path'] = paths
     df['Folder_id'] = [id] * len(df)       # add index to parent folder
     return df
 
 
-def join_and_anonymize(df_files, df_folders, write_dst):
+@prof.profiled
+def join_and_anonymize(df_files, df_folders, write_dst, mode='copy', n_jobs=1,
+                       incremental=False):
     '''Join file and folder tables and remove person names
+    See _rename_csvfiles() for how files are placed under write_dst.
     '''
     df_joined = pd.merge(df_folders[['Person_id', 'Trial']],
                          df_files[['Exercise', 'Legside', 'Resistance', 'Path', 'Folder_id']],
                          left_index=True, right_on='Folder_id')
 
-    df_joined = _rename_csvfiles(df_joined, write_dst)   # copy and overwrite path
+    df_joined = _rename_csvfiles(df_joined, write_dst, mode, n_jobs,   # copy and overwrite path
+                                 incremental)
 
     df_joined.drop('Folder_id', axis=1, inplace=True)  # don't need joining idx anymore
     return df_joined
 
 
+@prof.profiled
 def get_best_match(item, possible):
     '''Return the best matching string in the possible list.
     Otherwise return the original'''
@@ -90,12 +121,18 @@ def get_best_match(item, possible):
     return None
 
 
-def load_and_plot(df_files, write_dir='', plot_on=True):
+@prof.profiled
+def load_and_plot(df_files, write_dir='', plot_on=True, n_jobs=1):
     '''Loads and plots the csv files in df_files. Optionally saves pdf.
-    Labels are used as the title'''
-    for i in df_files.index:
+    Labels are used as the title.
+    Without plot_on, the pdfs are written by render_emg() in n_jobs processes.'''
+    if write_dir and not plot_on:
+        return render_emg(df_files, write_dir, fmt='pdf', n_jobs=n_jobs)
+
+    import visualization as viz
+
+    for i, df in zip(df_files.index, fop.prefetched(fop.load_emg, df_files.Path)):
         row = df_files.ix[i]
-        df = fop.load_emg(row.Path)
         title = str(row.tolist())
         fig, _ = viz.plot_emg(df, title=title)
 
@@ -103,23 +140,63 @@ def load_and_plot(df_files, write_dir='', plot_on=True):
             try: os.mkdir(write_dir)
             except: pass
             fig.savefig(os.path.join(write_dir, str(i) + '.pdf'))
-            if not plot_on:
-                viz.plt.close()
+        if not plot_on:
+            viz.plt.close(fig)
 
 
-def check_quality(df_files):
+@prof.profiled
+def render_emg(df_files, write_dst, fmt='png', n_jobs=1, chunksize=None):
+    '''Render the csv files in df_files without displaying them, titled by their labels.
+    If write_dst ends with .pdf, all files go to one multi-page pdf. Otherwise each is
+    written to write_dst/<index>.<fmt>, in n_jobs processes (-1 for all cores).
+    Returns the paths written.
+    '''
+    import render as rnd
+    titles = [str(row.tolist()) for _, row in df_files.iterrows()]
+
+    if write_dst.endswith('.pdf'):
+        from matplotlib.backends.backend_pdf import PdfPages
+
+        # workers load and decimate, the pages are drawn here as the lines arrive
+        lines = _pool_imap(rnd.decimated, df_files.Path, n_jobs, chunksize)
+        renderer = rnd.EMGRenderer()
+        with PdfPages(write_dst) as pages:
+            for page_lines, title in itertools.izip(lines, titles):
+                renderer.draw(page_lines, title)
+                renderer.save(pages)
+        return [write_dst]
+
+    if not os.path.isdir(write_dst):
+        os.makedirs(write_dst)
+    items = [(path, os.path.join(write_dst, '%s.%s' % (i, fmt)), title)
+             for i, path, title in zip(df_files.index, df_files.Path, titles)]
+    return _pool_map(_render_file, items, n_jobs, chunksize)
+
+
+@prof.profiled
+def check_quality(df_files, n_jobs=1, chunksize=None, plot_on=True, stats=False):
     '''Compile quality metrics into a dataframe and plot their distrubution
+    Files are checked in `n_jobs` processes (-1 for all cores), `chunksize` files at a time.
+    With `stats`, the mean peaks and top frequencies of each whole recording are added,
+    from the same pass over the data (see calcs.recording_stats).
     '''
-    d_summ = []
-    for path in df_files.Path:
-        d_summ.append(clc.quality(path))
+    if n_jobs == 1:
+        # one file after the other, read ahead if fileops.set_prefetch() is on
+        summarize = clc.recording_stats_arr if stats else clc.quality_arr
+        d_summ = [summarize(x) for x in fop.iter_emg(df_files.Path)]
+    else:
+        d_summ = _pool_map(clc.recording_stats if stats else clc.quality, df_files.Path,
+                           n_jobs, chunksize)
 
     df_quality = pd.DataFrame(d_summ, index=df_files.index)
-    viz.plot_qc(df_quality)
+    if plot_on:
+        import visualization as viz
+        viz.plot_qc(df_quality[_QC_COLS])
 
     return df_quality
 
 
+@prof.profiled
 def exclude_by_quality(df_files, df_quality, write_dir):
     '''Remove files that don't match the quality criteria.
     Also keep records of the removed files in the `write_dir` folder
@@ -150,40 +227,107 @@ def exclude_by_quality(df_files, df_quality, write_dir):
     return df_files
 
 
+@prof.profiled
 def split_by_personid(files, frac_apprx):
     '''Split files into two parts by person id.
     '''
     n_persons = len(files.Person_id.unique())
     n_left = int(frac_apprx * n_persons)
     files_left = files[files.Person_id < n_left]
-    files_right = files[files.Person_id > n_left]
+    files_right = files[files.Person_id >= n_left]
 
     return files_left, files_right
 
 
-def get_features(files, n_sec, standardize=False):
-    '''Sample data, calculate features, and collapse into a data frame.
+def person_shards(person_ids, n_shards, salt=''):
+    '''Shard (0 ... n_shards - 1) of each person id, from a hash of the id.
+    A person's shard only depends on the id, n_shards and salt, so any machine or
+    process can work out its shard without the rest of the table.
+    Change the salt for a different, equally reproducible assignment.
     '''
-    index = files.index
-    data_dict = fop.sample_data(files, n_sec)
+    person_ids = pd.Series(np.asarray(person_ids))
+    shards = dict((pid, _hash_shard(pid, n_shards, salt)) for pid in person_ids.unique())
+    return person_ids.map(shards).values
 
-    freq, peaks, phase = [], [], []
-    for ix in index:
-        df = data_dict[ix]
 
-        _, _, fc = clc.fft_df(df)
-        freq.append(fc[::-1])
+def shard_files(files, n_shards, i_shard, salt=''):
+    '''Files of the persons in shard i_shard of n_shards, see person_shards().
+    Shards can also be used as cross-validation folds that never split a person.
+    '''
+    return files[person_shards(files.Person_id, n_shards, salt) == i_shard]
 
-        peaks.append(clc.meanpeaks_df(df, 0.5))
 
-        phase.append(clc.phase_df(df))
+def iter_shard(files, n_shards, i_shard, salt='', chunksize=100000):
+    '''Yield the file ids in shard i_shard of n_shards, see person_shards().
+    files is a file table, or the path of one saved as csv (with the file ids as its
+    first column), which is read chunksize rows at a time.
+    '''
+    if isinstance(files, basestring):
+        chunks = pd.read_csv(files, index_col=0, chunksize=chunksize)
+    else:
+        chunks = (files.iloc[i:i + chunksize] for i in range(0, len(files), chunksize))
 
-    peak_cols = df.columns.values.tolist()
-    phase_cols = ['p_%s' % s for s in peak_cols]
-    columns = peak_cols + ['f1', 'f2'] + phase_cols
+    for chunk in chunks:
+        for ix in shard_files(chunk, n_shards, i_shard, salt).index:
+            yield ix
+
+
+@prof.profiled
+def get_features(files, n_sec, standardize=False, max_lag=None, hop_sec=None,
+                 max_windows=None, cache=None, nperseg=None, robust=False):
+    '''Sample data, calculate features, and collapse into a data frame.
+    Windows are stacked into one array and processed as a batch. Files too short
+    to fill the window are calculated one at a time.
+    Phase features only search lags up to `max_lag` samples, if given.
+    With `hop_sec`, every n_sec window `hop_sec` apart is used (at most `max_windows`
+    per file), instead of only the centred one. Rows are then indexed by file id and
+    the window's start sample.
+    With a featcache.FeatureCache as `cache`, only files not in it are calculated.
+    With `nperseg`, the frequency features come from Welch spectra with segments of
+    nperseg samples (see calcs.welch_batch), which are steadier on long windows.
+    With `robust`, peak features leave out outliers by median and MAD instead of z-score
+    (see calcs.meanpeaks_batch).
+    '''
+    columns = _feature_columns()
+    if cache is not None:
+        kwargs = dict(max_lag=max_lag, hop_sec=hop_sec, max_windows=max_windows)
+        if nperseg is not None:
+            kwargs['nperseg'] = nperseg   # keep the keys of the default features
+        if robust:
+            kwargs['robust'] = robust
+        feat = _get_features_cached(files, n_sec, cache, **kwargs)
+        if standardize:
+            feat = (feat - feat.mean()) / feat.std()
+
+        return feat
+
+    if hop_sec is not None:
+        keys, feat = [], []
+        for ix, windows, starts in fop.segment_data(files, n_sec, hop_sec, max_windows):
+            feat.append(clc.features_batch(windows, max_lag, nperseg, robust))
+            keys.extend((ix, i_start) for i_start in starts)
+
+        index = pd.MultiIndex.from_tuples(keys, names=[files.index.name, 'Window'])
+        feat = np.concatenate(feat) if feat else np.empty((0, len(columns)))
+        feat = pd.DataFrame(feat, index=index, columns=columns)
+
+        if standardize:
+            feat = (feat - feat.mean()) / feat.std()
+
+        return feat
+
+    index = files.index
+    arr, short = fop.sample_windows(files, n_sec)
 
-    arr = np.concatenate((peaks, freq, phase), axis=1)
-    feat = pd.DataFrame(arr, index=index, columns=columns)
+    feat = np.empty((len(files), len(columns)))
+    feat[~short] = clc.features_batch(arr[~short], max_lag, nperseg, robust)
+
+    if short.any():
+        data_dict = fop.sample_data(files[short], n_sec)
+        for i in np.flatnonzero(short):
+            feat[i] = _features_df(data_dict[index[i]], max_lag, nperseg, robust)
+
+    feat = pd.DataFrame(feat, index=index, columns=columns)
 
     if standardize:
         feat = (feat - feat.mean()) / feat.std()
@@ -191,7 +335,32 @@ def get_features(files, n_sec, standardize=False):
     return feat
 
 
+@prof.profiled
+def get_features_chunked(files, n_sec, store_dir, chunksize=1000, **kwargs):
+    '''Calculate features `chunksize` files at a time and append each chunk to the
+    store in store_dir, so memory stays at one chunk however many files there are.
+    Files already in the store are skipped, so a run that was stopped can be restarted.
+    Other arguments are passed to get_features(). Standardize after loading the whole
+    table with fileops.load_features().
+    '''
+    if kwargs.get('standardize'):
+        raise ValueError('standardize the features after fileops.load_features()')
+
+    done = fop.stored_file_ids(store_dir)
+    todo = files[~files.index.isin(done)]
+    print 'Skipping %d files already in "%s"' % (len(files) - len(todo), store_dir)
+
+    for i in range(0, len(todo), chunksize):
+        chunk = todo.iloc[i:i + chunksize]
+        fop.append_features(store_dir, chunk.index, get_features(chunk, n_sec, **kwargs))
+        print 'Stored features of %d of %d files' % (i + len(chunk), len(todo))
+
+    return len(todo)
+
+
+@prof.profiled
 def prediction_report(predicted, labels, classes, plot_on=True, print_mat=''):
+    from sklearn import metrics
 
     avg_correct = sum(predicted==labels) / len(predicted) * 100
     print '\npercent correct:', avg_correct
@@ -204,6 +373,7 @@ def prediction_report(predicted, labels, classes, plot_on=True, print_mat=''):
 
     frac_predicted = (mat.T / counts).T
     if plot_on:
+        import visualization as viz
         viz.plot_confusion(frac_predicted, classes)
 
     if print_mat == 'mat':
@@ -217,13 +387,6 @@ def prediction_report(predicted, labels, classes, plot_on=True, print_mat=''):
 ###################################################
 
 
-def _to_dataframe(labels, names):
-    if len(labels) == 0:
-        return []
-    else:
-        return pd.DataFrame(labels, columns=names)
-
-
 def _select_parsed(df, write_dst):
     '''Save record of all items in DataFrame.
     Return only items that were successfully parsed.
@@ -236,34 +399,176 @@ def _select_parsed(df, write_dst):
 
 
 def _name_to_id(S_name):
-    '''replace names in series with numberical identifiers
+    '''replace names in series with numberical identifiers, in order of appearance
     '''
-    name_unq = S_name.unique()
-    left = pd.DataFrame({'name': S_name})
-    right = pd.DataFrame({'name': name_unq,
-                          'id': range(len(name_unq))})
-    return pd.merge(left, right)['id']
+    return pd.Series(pd.factorize(S_name)[0], index=S_name.index)
 
 
-def _rename_csvfiles(df_files, write_dir):
-    '''rename csv files by file index
+def _hash_shard(person_id, n_shards, salt=''):
+    if isinstance(person_id, (float, np.floating)) and float(person_id).is_integer():
+        person_id = int(person_id)   # e.g. ids read back from a csv with gaps
+    digest = hashlib.md5(('%s:%s' % (salt, person_id)).encode('utf-8')).hexdigest()
+    return int(digest[:15], 16) % n_shards
+
+
+def _pool_map(func, items, n_jobs=1, chunksize=None, threads=False):
+    '''Map func over items in n_jobs processes (-1 for all cores), keeping the order
+    Use threads instead for I/O-bound work.
     '''
+    items = list(items)
+    if n_jobs < 0:
+        n_jobs = mp.cpu_count()
+    if n_jobs == 1 or len(items) <= 1:
+        return map(func, items)
+
+    if chunksize is None:
+        # a few chunks per worker, to balance files of different lengths
+        chunksize = max(1, len(items) // (4 * n_jobs))
+
+    pool = ThreadPool(n_jobs) if threads else mp.Pool(n_jobs)
     try:
-        shutil.rmtree(write_dir)
-    except:
-        pass
-    os.mkdir(write_dir)
+        return pool.map(func, items, chunksize)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _pool_imap(func, items, n_jobs=1, chunksize=None):
+    '''Like _pool_map(), but yield the results in order as they arrive. At most a few
+    chunks per process are done ahead of the consumer, so memory stays bounded when
+    the results are big and used one at a time.
+    '''
+    items = list(items)
+    if n_jobs < 0:
+        n_jobs = mp.cpu_count()
+    if n_jobs == 1 or len(items) <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    if chunksize is None:
+        chunksize = max(1, min(len(items) // (4 * n_jobs), 16))
+    n_ahead = 4 * n_jobs * chunksize
+
+    pool = mp.Pool(n_jobs)
+    try:
+        for start in range(0, len(items), n_ahead):
+            for result in pool.imap(func, items[start:start + n_ahead], chunksize):
+                yield result
+    except BaseException:
+        # e.g. the consumer stopped early: don't wait for the rest
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
 
-    path_new = []
-    ix__path = zip(df_files.index, df_files.Path)
-    for ix, src in ix__path:
-        dst = os.path.join(write_dir, str(ix) + '.csv')
-        shutil.copy(src, dst)
-        path_new.append(dst)
 
-    print 'Copied %d files and renamed by file_id. See "%s"' % (
-        len(df_files), write_dir)
+def _render_file(item):
+    import render as rnd
+    return rnd.render_file(*item)
+
+
+def _feature_columns():
+    peak_cols = list(fop.EMG_COLS)
+    phase_cols = ['p_%s' % s for s in peak_cols]
+    return peak_cols + ['f1', 'f2'] + phase_cols
+
+
+def _get_features_cached(files, n_sec, cache, **kwargs):
+    '''get_features(), with the rows of each file looked up in the cache first
+    '''
+    params = dict(kwargs, n_sec=n_sec)
+    keys = [cache.key(csv_path, params) for csv_path in files.Path]
+    blocks = [cache.get(key) for key in keys]
+
+    is_miss = np.array([block is None for block in blocks], dtype=bool)
+    if is_miss.any():
+        feat = get_features(files[is_miss], n_sec, **kwargs)
+        for i in np.flatnonzero(is_miss):
+            ix = files.index[i]
+            if kwargs['hop_sec'] is None:
+                block = feat.loc[[ix]].values, np.array([-1])
+            elif ix in feat.index.get_level_values(0):
+                rows = feat.xs(ix, level=0)
+                block = rows.values, rows.index.values
+            else:
+                block = np.empty((0, feat.shape[1])), np.array([], dtype=int)
+            cache.put(keys[i], *block)
+            blocks[i] = block
+
+    columns = _feature_columns()
+    if kwargs['hop_sec'] is None:
+        return pd.DataFrame(np.concatenate([rows for rows, _ in blocks]),
+                            index=files.index, columns=columns)
+
+    index = pd.MultiIndex.from_tuples(
+        [(ix, i_start) for ix, (_, starts) in zip(files.index, blocks) for i_start in starts],
+        names=[files.index.name, 'Window'])
+    feat = np.concatenate([rows for rows, _ in blocks] + [np.empty((0, len(columns)))])
+    return pd.DataFrame(feat, index=index, columns=columns)
+
+
+def _features_df(df, max_lag=None, nperseg=None, robust=False):
+    '''Feature row for a single window, as in get_features()
+    '''
+    if nperseg is None:
+        _, _, fc = clc.fft_df(df)
+        fc = fc[::-1]
+    else:
+        _, _, fc = clc.welch_batch(df.values[np.newaxis], nperseg)
+        fc = fc[0]
+    if robust:
+        peaks = clc.meanpeaks_batch(df.values[np.newaxis], 0.5, robust)[0]
+    else:
+        peaks = clc.meanpeaks_df(df, 0.5)
+    phase = clc.phase_df(df, max_lag=max_lag)
+    return np.concatenate((peaks, fc, phase))
+
+
+def _rename_csvfiles(df_files, write_dir, mode='copy', n_jobs=1, incremental=False):
+    '''rename csv files by file index
+    mode 'link' links the files instead of copying them, see fileops.place_file().
+    Mode 'symlink' may also symlink them, which keeps the original (named) paths
+    readable through the links.
+    Files are placed by n_jobs threads. With `incremental`, files already in write_dir
+    with the right content are kept, instead of starting from an empty folder.
+    '''
+    if incremental:
+        try: os.mkdir(write_dir)
+        except OSError: pass
+    else:
+        try:
+            shutil.rmtree(write_dir)
+        except:
+            pass
+        os.mkdir(write_dir)
+
+    path_new = [os.path.join(write_dir, str(ix) + '.csv') for ix in df_files.index]
+    if incremental:
+        # remove files of ids that are no longer in the table
+        for fn in set(fnmatch.filter(os.listdir(write_dir), '*.csv')) - set(
+                os.path.basename(dst) for dst in path_new):
+            os.remove(os.path.join(write_dir, fn))
+
+    src__dst = [(src, dst, mode, incremental) for src, dst in zip(df_files.Path, path_new)]
+    methods = _pool_map(_place_csvfile, src__dst, n_jobs, threads=True)
+
+    counts = pd.Series(methods).value_counts()
+    print 'Placed %d files and renamed by file_id (%s). See "%s"' % (
+        len(df_files), ', '.join('%s: %d' % kv for kv in counts.iteritems()), write_dir)
 
     df_files.Path = path_new
     return df_files
 
+
+def _place_csvfile(src__dst):
+    src, dst, mode, incremental = src__dst
+    if incremental and os.path.lexists(dst):
+        # a symlink left by an earlier mode='symlink' run is only kept in that mode
+        keep_link = mode == 'symlink' or not os.path.islink(dst)
+        if keep_link and os.path.exists(dst) and fop.same_content(src, dst):
+            return 'kept'
+        os.remove(dst)
+    return fop.place_file(src, dst, mode)
@@ -0,0 +1,152 @@
+'''Leave-persons-out cross-validation, hyperparameter sweeps and saved models.
+'''
+from __future__ import division
+
+import os
+import time
+import shutil
+import pickle
+import tempfile
+import itertools
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+from sklearn import svm, metrics
+from sklearn.preprocessing import StandardScaler
+
+# feature matrix, labels and folds of the current sweep, set in each worker
+_shared = {}
+
+
+def person_folds(person_ids, n_folds=5, seed=0):
+    '''Split rows into n_folds (train, test) index arrays, so that no person is in both.
+    Persons are shuffled with `seed` and dealt into folds of about equal size.
+    '''
+    person_ids = np.asarray(person_ids)
+    persons = np.unique(person_ids)
+    if len(persons) < n_folds:
+        raise ValueError('need at least %d persons for %d folds, not %d' % (
+            n_folds, n_folds, len(persons)))
+
+    persons = persons[np.random.RandomState(seed).permutation(len(persons))]
+    folds = []
+    for test_persons in np.array_split(persons, n_folds):
+        is_test = np.in1d(person_ids, test_persons)
+        folds.append((np.flatnonzero(~is_test), np.flatnonzero(is_test)))
+    return folds
+
+
+def param_list(param_grid):
+    '''Expand a dict of lists (or a list of them) into a list of parameter dicts
+    '''
+    if isinstance(param_grid, dict):
+        param_grid = [param_grid]
+
+    params = []
+    for grid in param_grid:
+        keys = sorted(grid)
+        for values in itertools.product(*[grid[k] for k in keys]):
+            params.append(dict(zip(keys, values)))
+    return params
+
+
+def fit_model(X, y, params, estimator=svm.SVC):
+    '''Fit a StandardScaler and estimator(**params) on X, y. Return (model, scaler).
+    '''
+    scaler = StandardScaler().fit(X)
+    model = estimator(**params).fit(scaler.transform(X), y)
+    return model, scaler
+
+
+def cross_validate(feat, labels, person_ids, param_grid, n_folds=5, n_jobs=1,
+                   estimator=svm.SVC, seed=0):
+    '''Score every parameter set in param_grid with leave-persons-out cross-validation.
+    All (parameters, fold) fits run in a pool of n_jobs processes (-1 for all cores).
+    The feature matrix is written once to a memory-mapped file that the workers share,
+    rather than being pickled to each of them.
+    Returns a table with one row per fit, and one with the mean scores per parameter set.
+    '''
+    X = np.ascontiguousarray(feat, dtype=np.float64)
+    y = np.asarray(labels)
+    folds = person_folds(person_ids, n_folds, seed)
+    params = param_list(param_grid)
+    tasks = [(i_params, p, i_fold, estimator)
+             for i_params, p in enumerate(params) for i_fold in range(n_folds)]
+
+    tmp_dir = tempfile.mkdtemp(prefix='athospy_cv_')
+    try:
+        x_path = os.path.join(tmp_dir, 'features.npy')
+        np.save(x_path, X)
+        init_args = (x_path, y, folds)
+
+        if n_jobs < 0:
+            n_jobs = mp.cpu_count()
+        if n_jobs == 1:
+            _init_worker(*init_args)
+            rows = map(_fit_score, tasks)
+        else:
+            pool = mp.Pool(n_jobs, _init_worker, init_args)
+            try:
+                rows = pool.map(_fit_score, tasks, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+    finally:
+        _shared.clear()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    results = pd.DataFrame(rows)
+    results['params'] = [str(params[i]) for i in results.i_params]
+
+    grouped = results.groupby('i_params')
+    summary = pd.DataFrame({'accuracy': grouped.accuracy.mean(),
+                            'accuracy_std': grouped.accuracy.std(),
+                            'recall': grouped.recall.mean(),
+                            'fit_sec': grouped.fit_sec.sum()},
+                           columns=['accuracy', 'accuracy_std', 'recall', 'fit_sec'])
+    summary.insert(0, 'params', [params[i] for i in summary.index])
+    return results, summary.sort_values('recall', ascending=False)
+
+
+def save_model(path, model, scaler, columns, **info):
+    '''Save a fitted model and scaler, with the feature columns they expect, to one file.
+    Uses the highest pickle protocol, which stores numpy arrays as raw bytes.
+    Pass the get_features() parameters (n_sec, max_lag, nperseg, robust) in info, so
+    serve.InferenceService makes the same features.
+    '''
+    bundle = dict(info, model=model, scaler=scaler, columns=list(columns))
+    with open(path, 'wb') as f:
+        pickle.dump(bundle, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_model(path):
+    '''Load what save_model() saved, as a dict with model, scaler, columns, ...
+    '''
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+# Helper functions
+###################################################
+
+
+def _init_worker(x_path, y, folds):
+    _shared['X'] = np.load(x_path, mmap_mode='r')
+    _shared['y'] = y
+    _shared['folds'] = folds
+
+
+def _fit_score(task):
+    i_params, params, i_fold, estimator = task
+    X, y = _shared['X'], _shared['y']
+    train, test = _shared['folds'][i_fold]
+
+    t_start = time.time()
+    model, scaler = fit_model(X[train], y[train], params, estimator)
+    predicted = model.predict(scaler.transform(X[test]))
+
+    return {'i_params': i_params, 'fold': i_fold,
+            'n_train': len(train), 'n_test': len(test),
+            'accuracy': metrics.accuracy_score(y[test], predicted),
+            'recall': metrics.recall_score(y[test], predicted, average='macro'),
+            'fit_sec': time.time() - t_start}
@@ -2,7 +2,6 @@ import pandas as pd
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 import numpy as np
-import seaborn as sns
 
 def set_styles():
     '''Sets matplotlib and pyplot plotting styles
@@ -90,9 +89,19 @@ def plot_confusion(mat, classes):
     cax.set_clim(vmin=0,vmax=1)
     
 
-def plot_feature_scatter(df_feat, df_files, write_dst=''):
+def plot_feature_scatter(df_feat, df_files, write_dst='', density=False, **kwargs):
     '''Plot scatter matrix for all features.
-    Save Exercise-labeled version of scatter plot for inspection'''
+    Save Exercise-labeled version of scatter plot for inspection.
+    With density, use plot_feature_density (kwargs go to it) instead, for large tables'''
+
+    if density:
+        fig, ax = plot_feature_density(df_feat, **kwargs)
+        if write_dst:
+            fig_labeled, _ = plot_feature_density(
+                df_feat, df_files.Exercise.loc[df_feat.index], **kwargs)
+            fig_labeled.savefig(write_dst)
+            plt.close(fig_labeled)
+        return ax
     
     # visualize features in the test set
     ax = pd.scatter_matrix(df_feat, alpha=0.2, figsize=(15, 15), diagonal='kde');
@@ -104,6 +113,8 @@ def plot_feature_scatter(df_feat, df_files, write_dst=''):
             axij.set_xticks([])
 
     if write_dst:
+        import seaborn as sns   # slow to import, and only needed here
+
         # also create and save a version of this plot with points colored by exercise label
         df_labeled = df_feat.join(df_files.Exercise)
 
@@ -116,4 +127,107 @@ def plot_feature_scatter(df_feat, df_files, write_dst=''):
         g.savefig(write_dst)
         plt.close() # don't create the plot here
 
-    return ax
\ No newline at end of file
+    return ax
+
+def pair_histograms(X, n_bins=50, chunksize=10000):
+    '''2-D histograms of all pairs of columns of X, counted together in one pass.
+    Returns counts of shape (n_col, n_col, n_bins, n_bins), where counts[i, j] bins
+    column i along the first axis and column j along the second (counts[i, i] is the
+    histogram of column i on the diagonal), and the (n_col, n_bins + 1) bin edges.
+    Rows with NaN are skipped. Rows are binned chunksize at a time to bound memory.
+    '''
+    X = np.asarray(X, dtype=float)
+    X = X[~np.isnan(X).any(axis=1)]
+    n_col = X.shape[1]
+
+    lo, hi = X.min(axis=0), X.max(axis=0)
+    span = np.where(hi > lo, hi - lo, 1)
+    edges = lo[:, np.newaxis] + span[:, np.newaxis] * np.linspace(0, 1, n_bins + 1)
+
+    # pairs i <= j, each with its own block of n_bins ** 2 counts
+    i_pair, j_pair = np.triu_indices(n_col)
+    offsets = np.arange(len(i_pair)) * n_bins ** 2
+
+    counts = np.zeros(len(i_pair) * n_bins ** 2, dtype=np.int64)
+    for start in range(0, len(X), chunksize):
+        codes = ((X[start:start + chunksize] - lo) / span * n_bins).astype(np.int64)
+        np.clip(codes, 0, n_bins - 1, out=codes)
+        flat = offsets + codes[:, i_pair] * n_bins + codes[:, j_pair]
+        counts += np.bincount(flat.ravel(), minlength=len(counts))
+
+    counts = counts.reshape(len(i_pair), n_bins, n_bins)
+    H = np.zeros((n_col, n_col, n_bins, n_bins), dtype=np.int64)
+    H[i_pair, j_pair] = counts
+    H[j_pair, i_pair] = counts.transpose(0, 2, 1)
+    return H, edges
+
+
+def subsample_classes(df, labels, max_per_class, seed=0):
+    '''At most max_per_class random rows of df for each value of labels
+    '''
+    rng = np.random.RandomState(seed)
+    labels = np.asarray(labels)
+    keep = []
+    for label in pd.unique(labels):
+        ix = np.flatnonzero(labels == label)
+        if len(ix) > max_per_class:
+            ix = np.sort(rng.choice(ix, max_per_class, replace=False))
+        keep.append(ix)
+    return df.iloc[np.sort(np.concatenate(keep))]
+
+
+def plot_feature_density(df_feat, labels=None, n_bins=50, max_per_class=None, seed=0,
+                         figsize=(15, 15)):
+    '''Scatter matrix of all features drawn as 2-D histograms (log counts), which
+    stays fast for any number of rows. The diagonal shows the histogram of each
+    feature, one line per class if labels are given.
+    With max_per_class, each class is first subsampled to that many rows.
+    All pairs are tiled into one image in a single axes, feature 0 top left.
+    '''
+    if labels is not None:
+        labels = pd.Series(np.asarray(labels), index=df_feat.index)
+        if max_per_class:
+            df_feat = subsample_classes(df_feat, labels, max_per_class, seed)
+            labels = labels.loc[df_feat.index]
+
+    H, edges = pair_histograms(df_feat.values, n_bins)
+    n_col = df_feat.shape[1]
+
+    # block (i, j) has feature i along y and j along x, each scaled to its own maximum
+    density = np.log1p(H).astype(float)
+    density /= np.maximum(density.max(axis=(2, 3), keepdims=True), 1)
+    density[np.arange(n_col), np.arange(n_col)] = 0
+    mosaic = density[::-1].transpose(0, 2, 1, 3).reshape(n_col * n_bins, n_col * n_bins)
+
+    fig, ax = plt.subplots(figsize=figsize)
+    ax.imshow(mosaic, origin='lower', cmap='Greys', interpolation='nearest',
+              extent=[0, n_col * n_bins, 0, n_col * n_bins])
+
+    # histograms on the diagonal, scaled to the height of a block
+    x = np.arange(n_bins) + 0.5
+    groups = [(None, np.ones(len(df_feat), dtype=bool))] if labels is None else \
+             [(label, (labels == label).values) for label in pd.unique(labels)]
+    for i in range(n_col):
+        x0, y0 = i * n_bins, (n_col - 1 - i) * n_bins
+        for k, (label, is_label) in enumerate(groups):
+            hist, _ = np.histogram(df_feat.values[is_label, i], edges[i])
+            ax.plot(x0 + x, y0 + 0.9 * n_bins * hist / max(hist.max(), 1),
+                    color='k' if label is None else 'C%d' % (k % 10),
+                    label=None if i else label)
+
+    bounds = np.arange(1, n_col) * n_bins
+    [ax.axvline(b, color='0.7', lw=0.5) for b in bounds]
+    [ax.axhline(b, color='0.7', lw=0.5) for b in bounds]
+    ticks = (np.arange(n_col) + 0.5) * n_bins
+    ax.set_xticks(ticks)
+    ax.set_xticklabels(df_feat.columns, rotation=90)
+    ax.set_yticks(ticks)
+    ax.set_yticklabels(df_feat.columns[::-1])
+    ax.set_xlim(0, n_col * n_bins)
+    ax.set_ylim(0, n_col * n_bins)
+    ax.grid(False)
+
+    if labels is not None:
+        ax.legend(loc='lower left', bbox_to_anchor=(0, 1), ncol=6)
+
+    return fig, ax
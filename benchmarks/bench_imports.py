@@ -0,0 +1,59 @@
+'''Check that the headless feature path imports quickly and without plotting or sklearn.
+
+    python benchmarks/bench_imports.py [budget_sec]
+
+Each import is timed in a fresh interpreter, best of a few runs. Exits non-zero
+if the budget is exceeded or a heavy module was pulled in.
+'''
+import os
+import sys
+import subprocess
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# modules a batch or streaming worker needs
+HEADLESS = ['athospy.top_fcns', 'athospy.fileops', 'athospy.calcs', 'athospy.stream']
+
+# and must not load until they're used. Some pandas versions import matplotlib
+# itself, so only pyplot (which sets up a backend) is checked
+HEAVY = ['matplotlib.pyplot', 'seaborn', 'sklearn', 'scipy.stats', 'scipy.signal']
+
+BUDGET_SEC = 1.5
+
+_SNIPPET = '''
+import sys, time
+t_start = time.time()
+%s
+print(time.time() - t_start)
+print(' '.join(m for m in %r if m in sys.modules))
+'''
+
+
+def import_time(modules, n_runs=3):
+    '''Best time to import modules in a new interpreter, and the heavy modules it loaded
+    '''
+    code = _SNIPPET % ('\n'.join('import ' + m for m in modules), HEAVY)
+    times = []
+    for _ in range(n_runs):
+        out = subprocess.check_output([sys.executable, '-c', code], cwd=REPO_DIR)
+        lines = out.decode().splitlines()
+        times.append(float(lines[0]))
+        loaded = lines[1].split() if len(lines) > 1 else []
+    return min(times), loaded
+
+
+def check_budget(budget_sec=BUDGET_SEC, modules=HEADLESS):
+    t_import, loaded = import_time(modules)
+    print 'imported %s in %.3f s (budget %.3f s)' % (', '.join(modules), t_import, budget_sec)
+
+    assert not loaded, 'headless import loaded %s' % ', '.join(loaded)
+    assert t_import <= budget_sec, 'import took %.3f s, over the %.3f s budget' % (
+        t_import, budget_sec)
+
+
+if __name__ == '__main__':
+    try:
+        check_budget(*[float(arg) for arg in sys.argv[1:2]])
+    except AssertionError as e:
+        print 'FAILED:', e
+        sys.exit(1)
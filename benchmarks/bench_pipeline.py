@@ -0,0 +1,271 @@
+'''Benchmark the loading, QC and feature stages on a synthetic EMG corpus.
+
+    python benchmarks/bench_pipeline.py --n-files 200 --rec-sec 60 --n-sec 5 --out results.json
+    python benchmarks/bench_pipeline.py --compare old.json new.json
+
+Each stage runs in a forked process, so its peak memory is measured on its own.
+Results (wall and cpu time, recordings/sec, samples/sec, peak RSS) are saved as json
+together with the configuration and git commit, so runs can be compared across commits.
+'''
+from __future__ import division
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import traceback
+import tempfile
+import resource
+import Queue
+import subprocess
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, REPO_DIR)
+
+import athospy.top_fcns as my
+import athospy.fileops as fop
+import athospy.calcs as clc
+
+FS = 41.7
+EXERCISES = ['Squat', 'Cycling', 'Stairs', 'Butt Blaster', 'Jog']
+
+
+def make_corpus(dirpath, n_files, rec_sec, seed=0):
+    '''Write n_files synthetic recordings of about rec_sec to dirpath, and return a file
+    table like the one from join_and_anonymize().
+    Channels are noisy bursts at an exercise-dependent rate, with dropouts and spikes.
+    '''
+    rng = np.random.RandomState(seed)
+    n_chan = len(fop.EMG_COLS)
+
+    rows = []
+    for i in range(n_files):
+        n_samp = int(FS * rec_sec * rng.uniform(0.8, 1.2))
+        i_exer = i % len(EXERCISES)
+        t = np.arange(n_samp) / FS
+
+        rate = 0.5 + 0.3 * i_exer   # bursts per second
+        phase = rng.uniform(0, 2 * np.pi, n_chan)
+        bursts = np.maximum(np.sin(2 * np.pi * rate * t[:, np.newaxis] + phase), 0)
+        x = 200 * rng.rand(n_chan) + 3000 * bursts ** 2 + rng.gamma(2, 50, (n_samp, n_chan))
+        x = x.astype(np.int64)
+        x[rng.rand(n_samp, n_chan) < 0.005] = 0
+        x[rng.rand(n_samp, n_chan) < 0.0005] = 65535
+
+        df = pd.DataFrame(x, columns=fop.EMG_COLS)
+        df.insert(0, 'Time', np.round(t, 3))
+        path = os.path.join(dirpath, '%d.csv' % i)
+        df.to_csv(path, index=False)
+
+        rows.append((i % 10, EXERCISES[i_exer], path))
+
+    return pd.DataFrame(rows, columns=['Person_id', 'Exercise', 'Path'])
+
+
+# stages: run after an untimed setup, which returns the stage's input (the file table
+# or the sampled windows). Each returns the number of recordings and samples processed
+
+
+def _stage_load_emg(files, cfg):
+    n_samp = sum(len(fop.load_emg(path)) for path in files.Path)
+    return len(files), n_samp
+
+
+def _stage_quality(files, cfg):
+    d_summ = [clc.quality(path) for path in files.Path]
+    return len(files), sum(d['Length'] for d in d_summ)
+
+
+def _stage_check_quality(files, cfg):
+    df_quality = my.check_quality(files, n_jobs=cfg['n_jobs'], plot_on=False)
+    return len(files), int(df_quality.Length.sum())
+
+
+def _stage_sample_data(files, cfg):
+    data_dict = fop.sample_data(files, cfg['n_sec'])
+    return len(files), sum(len(df) for df in data_dict.values())
+
+
+def _stage_get_features(files, cfg):
+    feat = my.get_features(files, cfg['n_sec'])
+    return len(feat), len(feat) * int(FS * cfg['n_sec'])
+
+
+def _per_window(fcn):
+    def stage(data_dict, cfg):
+        for df in data_dict.values():
+            fcn(df)
+        return len(data_dict), sum(len(df) for df in data_dict.values())
+    return stage
+
+
+def _files(files, cfg):
+    return files
+
+
+def _windows(files, cfg):
+    return fop.sample_data(files, cfg['n_sec'])
+
+
+STAGES = [('load_emg', _files, _stage_load_emg),
+          ('quality', _files, _stage_quality),
+          ('check_quality', _files, _stage_check_quality),
+          ('sample_data', _files, _stage_sample_data),
+          ('fft_df', _windows, _per_window(clc.fft_df)),
+          ('meanpeaks_df', _windows, _per_window(lambda df: clc.meanpeaks_df(df, 0.5))),
+          ('phase_df', _windows, _per_window(clc.phase_df)),
+          ('get_features', _files, _stage_get_features)]
+
+
+def run_stage(name, files, cfg):
+    '''Run one stage in a forked process and return its timings and peak memory.
+    Raises a RuntimeError if the stage fails or the process dies (e.g. killed when
+    out of memory), instead of waiting for a result that never comes.
+    '''
+    setup, stage = [(setup, stage) for n, setup, stage in STAGES if n == name][0]
+    queue = mp.Queue()
+
+    def child():
+        try:
+            data = setup(files, cfg)
+            rss_start = _rss_mb()
+            t_start, cpu_start = time.time(), time.clock()
+            n_rec, n_samp = stage(data, cfg)
+            wall, cpu = time.time() - t_start, time.clock() - cpu_start
+        except BaseException:
+            queue.put({'stage': name, 'error': traceback.format_exc()})
+            return
+        queue.put({'stage': name, 'wall_sec': wall, 'cpu_sec': cpu,
+                   'recordings': n_rec, 'samples': n_samp,
+                   'recordings_per_sec': n_rec / wall if wall else np.inf,
+                   'samples_per_sec': n_samp / wall if wall else np.inf,
+                   'peak_rss_mb': _peak_rss_mb(),
+                   'peak_rss_increase_mb': _peak_rss_mb() - rss_start})
+
+    proc = mp.Process(target=child)
+    proc.start()
+    result = None
+    while result is None:
+        try:
+            result = queue.get(timeout=1)
+        except Queue.Empty:
+            if not proc.is_alive():
+                # the result may have been put just before the process ended
+                try:
+                    result = queue.get(timeout=1)
+                except Queue.Empty:
+                    proc.join()
+                    raise RuntimeError('stage %s died with exit code %s'
+                                       % (name, proc.exitcode))
+    proc.join()
+
+    if 'error' in result:
+        raise RuntimeError('stage %s failed:\n%s' % (name, result['error']))
+    return result
+
+
+def run(cfg, stages=None):
+    '''Generate the corpus in a temporary folder, run the stages and return the results
+    '''
+    stages = stages or [name for name, _, _ in STAGES]
+    tmp_dir = tempfile.mkdtemp(prefix='athospy_bench_')
+    try:
+        t_start = time.time()
+        files = make_corpus(tmp_dir, cfg['n_files'], cfg['rec_sec'], cfg['seed'])
+        print 'generated %d files in %.1f s' % (len(files), time.time() - t_start)
+
+        if cfg['cache']:
+            fop.set_cache_dir(os.path.join(tmp_dir, 'cache'))
+            [fop.cache_entry(path) for path in files.Path]   # convert before timing
+
+        results = []
+        for name in stages:
+            results.append(run_stage(name, files, cfg))
+            print _format_row(results[-1])
+    finally:
+        fop.set_cache_dir('')
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return {'config': cfg, 'commit': _git_commit(), 'python': sys.version.split()[0],
+            'numpy': np.__version__, 'pandas': pd.__version__,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': results}
+
+
+def compare(old_json, new_json):
+    '''Table of new / old wall time and peak memory per stage
+    '''
+    dfs = []
+    for path in [old_json, new_json]:
+        with open(path) as f:
+            dfs.append(pd.DataFrame(json.load(f)['results']).set_index('stage'))
+    old, new = dfs
+
+    return pd.DataFrame({'old_sec': old.wall_sec, 'new_sec': new.wall_sec,
+                         'speedup': old.wall_sec / new.wall_sec,
+                         'old_rss_mb': old.peak_rss_increase_mb,
+                         'new_rss_mb': new.peak_rss_increase_mb},
+                        columns=['old_sec', 'new_sec', 'speedup', 'old_rss_mb', 'new_rss_mb'])
+
+
+# Helper functions
+###################################################
+
+
+def _rss_mb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / 2 ** 20
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in KB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def _format_row(r):
+    return '%-14s %8.3f s %10.1f rec/s %12.0f samp/s %8.1f MB peak (+%.1f)' % (
+        r['stage'], r['wall_sec'], r['recordings_per_sec'], r['samples_per_sec'],
+        r['peak_rss_mb'], r['peak_rss_increase_mb'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--n-files', type=int, default=100)
+    parser.add_argument('--rec-sec', type=float, default=60, help='recording length [sec]')
+    parser.add_argument('--n-sec', type=float, default=5, help='feature window [sec]')
+    parser.add_argument('--n-jobs', type=int, default=1, help='processes for check_quality')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cache', action='store_true', help='load through the binary cache')
+    parser.add_argument('--stages', nargs='+', choices=[name for name, _, _ in STAGES])
+    parser.add_argument('--out', help='save results to this json file')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two saved results instead of running')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        print compare(*args.compare).round(3)
+        return
+
+    cfg = {'n_files': args.n_files, 'rec_sec': args.rec_sec, 'n_sec': args.n_sec,
+           'n_jobs': args.n_jobs, 'seed': args.seed, 'cache': args.cache}
+    out = run(cfg, args.stages)
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(out, f, indent=1, sort_keys=True)
+        print 'saved results to "%s"' % args.out
+
+
+if __name__ == '__main__':
+    main()